@@ -0,0 +1,480 @@
+import sys
+import os
+import json
+import time
+import random
+import socket
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+HOST = '127.0.0.1'
+FORMAT = 'utf-8'
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_SCRIPT = os.path.join(REPO_DIR, 'server.py')
+DATABASE = os.path.join(REPO_DIR, 'memoSystem.db')
+DOCUMENT_ROOT = os.path.join(REPO_DIR, 'files-distribution')
+
+# what a client can do on each turn:
+#   poll    GET /api/memos with its session cookie
+#   post    POST a new memo
+#   churn   create a memo (through the batch endpoint, which tells us its id), then
+#           PUT new content into it, then DELETE it, one step per turn
+#   static  GET a file from the document root
+#   visit   GET /api/memos without a cookie, like a first visit. the server hands out a new
+#           session and stores its row, or with --session-keys only signs a cookie for it
+OPERATIONS = ['poll', 'post', 'churn', 'static', 'visit']
+
+
+# starts server.py in its own process and waits until it accepts connections.
+# the server works on a scratch copy of the database so benchmarks never touch the real one
+def start_server(mode, port, database, extra_arguments):
+    command = [sys.executable, SERVER_SCRIPT, '--mode', mode, '--port', str(port), '--database', database]
+    command += extra_arguments
+    process = subprocess.Popen(command, cwd=REPO_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            probe = socket.create_connection((HOST, port), timeout=1)
+            probe.close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+
+    process.kill()
+    raise RuntimeError('server in {} mode never started listening'.format(mode))
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+# reads exactly one response off the connection, using its Content-Length to
+# know where it ends. returns the status code and the raw response
+def read_response(conn, buffer=b''):
+    header_end = buffer.find(b'\r\n\r\n')
+    while header_end == -1:
+        chunk = conn.recv(65536)
+        if not chunk:
+            raise ConnectionError('server closed the connection mid-response')
+        buffer += chunk
+        header_end = buffer.find(b'\r\n\r\n')
+
+    content_length = 0
+    for line in buffer[:header_end].split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            content_length = int(value.strip())
+
+    response_end = header_end + 4 + content_length
+    while len(buffer) < response_end:
+        chunk = conn.recv(65536)
+        if not chunk:
+            raise ConnectionError('server closed the connection mid-response')
+        buffer += chunk
+
+    status = int(buffer.split(b' ', 2)[1])
+    return status, buffer[:response_end]
+
+
+# sends one request on a fresh connection that closes after the response
+def send_request(port, request):
+    conn = socket.create_connection((HOST, port), timeout=10)
+    try:
+        conn.sendall(request)
+        return read_response(conn)
+    finally:
+        conn.close()
+
+
+# sends a request on a kept-alive connection, held in connection[0]. a new connection
+# is opened when there isn't one yet or the server closed the last one
+def send_keep_alive(connection, port, request):
+    if connection[0] is None:
+        connection[0] = socket.create_connection((HOST, port), timeout=10)
+
+    try:
+        connection[0].sendall(request)
+        status, response = read_response(connection[0])
+    except OSError:
+        close_keep_alive(connection)
+        raise
+
+    # the server hit its per-connection limit, start a new one next time
+    if b'Connection: close' in response.split(b'\r\n\r\n', 1)[0]:
+        close_keep_alive(connection)
+
+    return status, response
+
+
+def close_keep_alive(connection):
+    if connection[0] is not None:
+        connection[0].close()
+        connection[0] = None
+
+
+# the first visit hands out a session cookie, which later requests send back
+def get_session_cookie(port):
+    status, response = send_request(port, build_request('GET', '/api/memos'))
+    for line in response.split(b'\r\n\r\n', 1)[0].split(b'\r\n'):
+        if line.startswith(b'Set-Cookie: '):
+            return line[len(b'Set-Cookie: '):].decode(FORMAT)
+    return None
+
+
+def build_request(method, path, cookie=None, body='', keep_alive=False):
+    lines = ['{} {} HTTP/1.1'.format(method, path), 'Host: {}'.format(HOST)]
+    if not keep_alive:
+        lines.append('Connection: close')
+    if cookie is not None:
+        lines.append('Cookie: {}'.format(cookie))
+    encoded_body = body.encode(FORMAT)
+    if encoded_body:
+        lines.append('Content-Type: application/json')
+        lines.append('Content-Length: {}'.format(len(encoded_body)))
+    return '{}\r\n\r\n'.format('\r\n'.join(lines)).encode(FORMAT) + encoded_body
+
+
+# "poll=70,churn=20,static=10" -> [['poll', 70], ['churn', 20], ['static', 10]]
+def parse_mix(text):
+    mix = []
+
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError('unknown operation {!r}, pick from {}'.format(name, ', '.join(OPERATIONS)))
+        weight = weight.strip() or '1'
+        if not weight.isdecimal() or int(weight) == 0:
+            raise argparse.ArgumentTypeError('weight for {} must be a positive whole number'.format(name))
+        mix.append([name, int(weight)])
+
+    return mix
+
+
+# every file the server would serve from the document root, as request paths
+def static_paths(document_root):
+    paths = []
+
+    for root, directories, files in os.walk(document_root):
+        directories[:] = [name for name in directories if not name.startswith('.')]
+        for name in files:
+            if not name.startswith('.'):
+                relative_path = os.path.relpath(os.path.join(root, name), document_root)
+                paths.append('/' + relative_path.replace(os.sep, '/'))
+
+    return sorted(paths)
+
+
+def response_body(response):
+    return response.split(b'\r\n\r\n', 1)[1]
+
+
+# makes one request of the given kind for a client.
+# param client: the client's state, {'cookie', 'connection', 'memo_id', 'updated'}
+# return: [name to record it under, status code]
+def run_operation(kind, port, client, keep_alive, paths):
+    cookie = client['cookie']
+    name = kind
+
+    if kind == 'poll':
+        request = build_request('GET', '/api/memos', cookie, keep_alive=keep_alive)
+    elif kind == 'visit':
+        request = build_request('GET', '/api/memos', keep_alive=keep_alive)
+    elif kind == 'post':
+        request = build_request('POST', '/api/memos', cookie, json.dumps({'content': 'benchmark memo'}), keep_alive)
+    elif kind == 'static':
+        request = build_request('GET', random.choice(paths), cookie, keep_alive=keep_alive)
+
+    # churn takes three turns per memo
+    elif client['memo_id'] is None:
+        name = 'churn_create'
+        body = json.dumps([{'op': 'create', 'content': 'churn memo'}])
+        request = build_request('POST', '/api/memos/batch', cookie, body, keep_alive)
+    elif not client['updated']:
+        name = 'churn_update'
+        body = json.dumps({'content': 'churned memo'})
+        request = build_request('PUT', '/api/memos/{}'.format(client['memo_id']), cookie, body, keep_alive)
+    else:
+        name = 'churn_delete'
+        request = build_request('DELETE', '/api/memos/{}'.format(client['memo_id']), cookie, keep_alive=keep_alive)
+
+    if keep_alive:
+        status, response = send_keep_alive(client['connection'], port, request)
+    else:
+        status, response = send_request(port, request)
+
+    if name == 'churn_create' and status < 400:
+        client['memo_id'] = json.loads(response_body(response))['results'][0]['memo_id']
+    elif name == 'churn_update' and status < 400:
+        client['updated'] = True
+    elif name == 'churn_delete':
+        # start on a new memo either way, in case this one is gone
+        client['memo_id'] = None
+        client['updated'] = False
+
+    return [name, status]
+
+
+# opens connections that never send anything, like slow or idle clients would
+def open_idle_connections(port, count):
+    idle = []
+    for _ in range(count):
+        try:
+            idle.append(socket.create_connection((HOST, port), timeout=10))
+        except OSError:
+            break
+    return idle
+
+
+# each client thread picks an operation from the mix, weighted, over and over until the
+# time runs out. with keep_alive every client reuses one connection, otherwise it
+# reconnects every time. every client has a session of its own, made before the clock starts
+def run_clients(port, mix, concurrency, duration, keep_alive=False, paths=()):
+    # name -> [latencies of the ones that worked, error count]
+    recorded = {}
+    lock = threading.Lock()
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    clients = [{'cookie': get_session_cookie(port), 'connection': [None], 'memo_id': None, 'updated': False}
+               for _ in range(concurrency)]
+    deadline = time.monotonic() + duration
+
+    def run_client(client):
+        my_recorded = {}
+        while time.monotonic() < deadline:
+            kind = random.choices(names, weights)[0]
+            name = kind
+            started = time.perf_counter()
+            try:
+                name, status = run_operation(kind, port, client, keep_alive, paths)
+                failed = status >= 400
+            except (OSError, ValueError, KeyError):
+                failed = True
+
+            latencies_and_errors = my_recorded.setdefault(name, [[], 0])
+            if failed:
+                latencies_and_errors[1] += 1
+            else:
+                latencies_and_errors[0].append(time.perf_counter() - started)
+        close_keep_alive(client['connection'])
+
+        with lock:
+            for name, (latencies, errors) in my_recorded.items():
+                latencies_and_errors = recorded.setdefault(name, [[], 0])
+                latencies_and_errors[0].extend(latencies)
+                latencies_and_errors[1] += errors
+
+    threads = [threading.Thread(target=run_client, args=(client,)) for client in clients]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    all_latencies = [latency for latencies, _ in recorded.values() for latency in latencies]
+    result = summarize(all_latencies, sum(errors for _, errors in recorded.values()), elapsed)
+    result['operations'] = {name: summarize(latencies, errors, elapsed)
+                            for name, (latencies, errors) in sorted(recorded.items())}
+    return result
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+# param latencies: seconds each successful request took
+# param errors: requests that got a 4xx or 5xx, or no answer at all
+def summarize(latencies, errors, elapsed):
+    latencies.sort()
+    attempts = len(latencies) + errors
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'error_rate': errors / attempts if attempts else 0.0,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+# runs the same mix of requests against each server mode
+def compare_modes(arguments):
+    results = {}
+    paths = static_paths(DOCUMENT_ROOT)
+    scratch = tempfile.mkdtemp()
+    try:
+        for offset, mode in enumerate(arguments.modes):
+            port = arguments.port + offset
+            database = os.path.join(scratch, '{}.db'.format(mode))
+            shutil.copyfile(DATABASE, database)
+
+            process = start_server(mode, port, database, arguments.server_arguments)
+            try:
+                idle = open_idle_connections(port, arguments.idle)
+                results[mode] = run_clients(port, arguments.mix, arguments.concurrency, arguments.duration,
+                                            arguments.keep_alive, paths)
+                results[mode]['idle_connections'] = len(idle)
+                for conn in idle:
+                    conn.close()
+            finally:
+                stop_server(process)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    return results
+
+
+def memo_ids(port, cookie):
+    status, response = send_request(port, build_request('GET', '/api/memos', cookie))
+    body = response.split(b'\r\n\r\n', 1)[1]
+    return [memo['memo_id'] for memo in json.loads(body)] if body else []
+
+
+# creates and then deletes the same number of memos, first one request per memo and
+# then with a single POST /api/memos/batch for each, and reports memos per second
+def compare_batch(arguments):
+    results = {}
+    scratch = tempfile.mkdtemp()
+    database = os.path.join(scratch, 'batch.db')
+    shutil.copyfile(DATABASE, database)
+    count = arguments.batch_size
+
+    process = start_server(arguments.modes[0], arguments.port, database, [])
+    try:
+        cookie = get_session_cookie(arguments.port)
+        connection = [None]
+
+        # one request per memo
+        existing = set(memo_ids(arguments.port, cookie))
+        started = time.perf_counter()
+        for number in range(count):
+            body = json.dumps({'content': 'memo {}'.format(number)})
+            send_keep_alive(connection, arguments.port, build_request('POST', '/api/memos', cookie, body, True))
+        create_elapsed = time.perf_counter() - started
+
+        created = [memo_id for memo_id in memo_ids(arguments.port, cookie) if memo_id not in existing]
+        started = time.perf_counter()
+        for memo_id in created:
+            send_keep_alive(connection, arguments.port,
+                            build_request('DELETE', '/api/memos/{}'.format(memo_id), cookie, keep_alive=True))
+        delete_elapsed = time.perf_counter() - started
+        results['single'] = {'memos': count, 'creates_per_s': count / create_elapsed,
+                             'deletes_per_s': len(created) / delete_elapsed}
+
+        # the same work as one batch each
+        body = json.dumps([{'op': 'create', 'content': 'memo {}'.format(number)} for number in range(count)])
+        started = time.perf_counter()
+        _, response = send_keep_alive(connection, arguments.port,
+                                      build_request('POST', '/api/memos/batch', cookie, body, True))
+        create_elapsed = time.perf_counter() - started
+
+        batch_results = json.loads(response.split(b'\r\n\r\n', 1)[1])['results']
+        body = json.dumps([{'op': 'delete', 'memo_id': result['memo_id']} for result in batch_results])
+        started = time.perf_counter()
+        send_keep_alive(connection, arguments.port, build_request('POST', '/api/memos/batch', cookie, body, True))
+        delete_elapsed = time.perf_counter() - started
+        results['batch'] = {'memos': count, 'creates_per_s': count / create_elapsed,
+                            'deletes_per_s': count / delete_elapsed}
+
+        close_keep_alive(connection)
+    finally:
+        stop_server(process)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    return results
+
+
+def print_batch_results(results):
+    print('{:<10}{:>10}{:>16}{:>16}'.format('requests', 'memos', 'creates/s', 'deletes/s'))
+    for kind, result in results.items():
+        print('{:<10}{:>10}{:>16.1f}{:>16.1f}'.format(kind, result['memos'], result['creates_per_s'],
+                                                      result['deletes_per_s']))
+
+
+def print_results(results):
+    row = '{:<10}{:<14}{:>10}{:>12}{:>10}{:>10}{:>10}{:>8}'
+    print(row.format('mode', 'operation', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+
+    row = '{:<10}{:<14}{:>10}{:>12.1f}{:>10.2f}{:>10.2f}{:>10.2f}{:>8}'
+    for mode, result in results.items():
+        # the total first, then one row per kind of request when there's more than one
+        rows = [['all', result]]
+        if len(result['operations']) > 1:
+            rows += list(result['operations'].items())
+        for name, summary in rows:
+            print(row.format(mode, name, summary['requests'], summary['throughput'], summary['p50_ms'],
+                             summary['p95_ms'], summary['p99_ms'], summary['errors']))
+
+
+# param path: file to write to, or '-' for stdout
+def write_json(path, arguments, results):
+    report = {
+        'settings': {
+            'modes': arguments.modes,
+            'mix': dict(arguments.mix),
+            'concurrency': arguments.concurrency,
+            'duration': arguments.duration,
+            'idle': arguments.idle,
+            'keep_alive': arguments.keep_alive,
+            'server_arguments': arguments.server_arguments,
+        },
+        'results': results,
+    }
+
+    if path == '-':
+        json.dump(report, sys.stdout, indent=4)
+        print()
+    else:
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=4)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the memo server modes side by side')
+    parser.add_argument('--modes', nargs='+', default=['threads', 'async'],
+                        choices=['threads', 'pool', 'async'], help='server modes to compare')
+    parser.add_argument('--port', type=int, default=18265, help='first port to run servers on')
+    parser.add_argument('--concurrency', type=int, default=16, help='clients sending requests at once')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds to run each mode for')
+    parser.add_argument('--idle', type=int, default=0, help='idle connections to hold open during the run')
+    parser.add_argument('--keep-alive', action='store_true', help='reuse one connection per client')
+    parser.add_argument('--mix', type=parse_mix, default=[['poll', 1]],
+                        help='weighted mix of {} like "poll=70,churn=20,static=10"'.format(', '.join(OPERATIONS)))
+    parser.add_argument('--json', metavar='FILE',
+                        help="also write the settings and results as JSON to FILE, '-' for stdout only")
+    parser.add_argument('--server-arguments', nargs=argparse.REMAINDER, default=[],
+                        help='everything after this is passed on to server.py')
+    parser.add_argument('--batch-size', type=int, default=0,
+                        help='instead of comparing modes, time this many single-memo requests against one batch')
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    if arguments.batch_size:
+        print_batch_results(compare_batch(arguments))
+    else:
+        results = compare_modes(arguments)
+        if arguments.json != '-':
+            print_results(results)
+        if arguments.json:
+            write_json(arguments.json, arguments, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+# thread-safe least-recently-used cache. once it holds max_entries, or its entries
+# add up to more than max_bytes, the entries that went unused the longest get evicted.
+# entries older than ttl seconds count as missing. hits and misses are counted so we
+# can tell if it's earning its keep
+class LRUCache:
+    def __init__(self, max_entries=None, ttl=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # key -> [value, time it expires or None, size in bytes]
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            if entry[1] is not None and entry[1] <= time.monotonic():
+                self.remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    # param size: how much of the max_bytes budget this entry uses up
+    def put(self, key, value, size=0):
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = [value, expires, size]
+            self.total_bytes += size
+
+            while self.entries and self.over_budget():
+                oldest = next(iter(self.entries))
+                self.remove(oldest)
+                self.evictions += 1
+
+    def over_budget(self):
+        too_many = self.max_entries is not None and len(self.entries) > self.max_entries
+        too_big = self.max_bytes is not None and self.total_bytes > self.max_bytes
+        return too_many or too_big
+
+    # only call this while holding the lock
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+    def discard(self, key):
+        with self.lock:
+            self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def statistics(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,217 @@
+# default limits on what a single request can send us
+MAX_HEADER_SIZE = 16384
+MAX_BODY_SIZE = 1048576
+# a chunk size line is a handful of hex digits plus optional extensions
+MAX_CHUNK_LINE_SIZE = 1024
+
+HEADER_END = b'\r\n\r\n'
+LINE_END = b'\r\n'
+
+# what the parser is waiting for next
+READING_HEADER = 0
+READING_BODY = 1
+READING_CHUNK_SIZE = 2
+READING_CHUNK_DATA = 3
+READING_TRAILER = 4
+
+
+# raised when a request can't be parsed. status is the HTTP status line the
+# client should get back, after which the connection has to be closed since we
+# no longer know where the next request starts
+class ParseError(Exception):
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+# content-length -> Content-Length, so lookups don't depend on how the client spelled it
+def canonical_header_name(name):
+    return '-'.join(part.capitalize() for part in name.split('-'))
+
+
+# turns the request line and header lines into [method, path, version, headers]
+def parse_header(header_bytes):
+    try:
+        header_text = header_bytes.decode('iso-8859-1')
+    except UnicodeDecodeError:
+        raise ParseError('400 Bad Request')
+
+    lines = header_text.split('\r\n')
+    request_line = lines[0].split(' ')
+    if len(request_line) != 3 or not request_line[0] or not request_line[1]:
+        raise ParseError('400 Bad Request')
+
+    headers = {}
+    for line in lines[1:]:
+        name, separator, value = line.partition(':')
+        if not separator or not name or name != name.strip():
+            raise ParseError('400 Bad Request')
+
+        name = canonical_header_name(name)
+        value = value.strip()
+        # repeated headers get folded into one value
+        if name in headers:
+            joiner = '; ' if name == 'Cookie' else ', '
+            value = '{}{}{}'.format(headers[name], joiner, value)
+        headers[name] = value
+
+    return [request_line[0], request_line[1], request_line[2], headers]
+
+
+# incremental HTTP/1.1 request parser. feed() it bytes as they arrive off the socket
+# and next_request() hands back each request once all of it is in. every byte is
+# looked at a constant number of times, and consumed bytes are dropped from the
+# front of the buffer so pipelined requests don't pile up
+class RequestParser:
+    def __init__(self, max_header_size=MAX_HEADER_SIZE, max_body_size=MAX_BODY_SIZE):
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.buffer = bytearray()
+        # where to resume looking for the end of the header
+        self.search_from = 0
+        self.state = READING_HEADER
+        self.request = None
+        self.body = None
+        self.remaining = 0
+        # true once a client that sent "Expect: 100-continue" is waiting on us
+        self.continue_pending = False
+
+    def feed(self, data):
+        self.buffer += data
+
+    # returns the next whole request as a dict with method, path, version,
+    # headers and body (bytes), or None if more data is needed.
+    # raises ParseError if the request is malformed or over the limits
+    def next_request(self):
+        progress = True
+        while progress:
+            if self.state == READING_HEADER:
+                progress = self.read_header()
+            elif self.state == READING_BODY:
+                progress = self.read_body()
+            elif self.state == READING_CHUNK_SIZE:
+                progress = self.read_chunk_size()
+            elif self.state == READING_CHUNK_DATA:
+                progress = self.read_chunk_data()
+            else:
+                progress = self.read_trailer()
+
+            if self.state == READING_HEADER and self.request is not None:
+                return self.finish_request()
+
+        return None
+
+    def read_header(self):
+        header_end = self.buffer.find(HEADER_END, self.search_from)
+
+        if header_end == -1:
+            if len(self.buffer) > self.max_header_size:
+                raise ParseError('431 Request Header Fields Too Large')
+            # the terminator could straddle this read and the next one
+            self.search_from = max(0, len(self.buffer) - len(HEADER_END) + 1)
+            return False
+
+        if header_end > self.max_header_size:
+            raise ParseError('431 Request Header Fields Too Large')
+
+        method, path, version, headers = parse_header(bytes(self.buffer[:header_end]))
+        del self.buffer[:header_end + len(HEADER_END)]
+        self.search_from = 0
+        self.request = {'method': method, 'path': path, 'version': version, 'headers': headers}
+        self.body = bytearray()
+
+        transfer_encoding = headers.get('Transfer-Encoding', '').lower()
+        if transfer_encoding:
+            # chunked is the only transfer coding we understand
+            if [coding.strip() for coding in transfer_encoding.split(',')] != ['chunked']:
+                raise ParseError('501 Not Implemented')
+            self.state = READING_CHUNK_SIZE
+
+        elif 'Content-Length' in headers:
+            content_length = headers['Content-Length']
+            if not content_length.isdecimal():
+                raise ParseError('400 Bad Request')
+            self.remaining = int(content_length)
+            if self.remaining > self.max_body_size:
+                raise ParseError('413 Payload Too Large')
+            self.state = READING_BODY if self.remaining else READING_HEADER
+
+        else:
+            self.state = READING_HEADER
+
+        if self.state != READING_HEADER and headers.get('Expect', '').lower() == '100-continue':
+            self.continue_pending = True
+
+        return True
+
+    def read_body(self):
+        if len(self.buffer) < self.remaining:
+            return False
+
+        self.body = self.buffer[:self.remaining]
+        del self.buffer[:self.remaining]
+        self.state = READING_HEADER
+        return True
+
+    def read_chunk_size(self):
+        line_end = self.buffer.find(LINE_END)
+        if line_end == -1:
+            if len(self.buffer) > MAX_CHUNK_LINE_SIZE:
+                raise ParseError('400 Bad Request')
+            return False
+
+        # chunk extensions after the ";" are allowed but we ignore them
+        size_text = bytes(self.buffer[:line_end]).split(b';', 1)[0].strip()
+        try:
+            chunk_size = int(size_text, 16)
+        except ValueError:
+            raise ParseError('400 Bad Request')
+        if chunk_size < 0:
+            raise ParseError('400 Bad Request')
+
+        del self.buffer[:line_end + len(LINE_END)]
+
+        if chunk_size == 0:
+            self.state = READING_TRAILER
+        else:
+            if len(self.body) + chunk_size > self.max_body_size:
+                raise ParseError('413 Payload Too Large')
+            self.remaining = chunk_size
+            self.state = READING_CHUNK_DATA
+
+        return True
+
+    def read_chunk_data(self):
+        # the chunk data is followed by its own CRLF
+        if len(self.buffer) < self.remaining + len(LINE_END):
+            return False
+
+        if self.buffer[self.remaining:self.remaining + len(LINE_END)] != LINE_END:
+            raise ParseError('400 Bad Request')
+
+        self.body += self.buffer[:self.remaining]
+        del self.buffer[:self.remaining + len(LINE_END)]
+        self.state = READING_CHUNK_SIZE
+        return True
+
+    # trailer fields after the last chunk are read and thrown away
+    def read_trailer(self):
+        line_end = self.buffer.find(LINE_END)
+        if line_end == -1:
+            if len(self.buffer) > self.max_header_size:
+                raise ParseError('431 Request Header Fields Too Large')
+            return False
+
+        del self.buffer[:line_end + len(LINE_END)]
+        if line_end == 0:
+            self.state = READING_HEADER
+
+        return True
+
+    def finish_request(self):
+        request = self.request
+        request['body'] = bytes(self.body)
+        self.request = None
+        self.body = None
+        self.continue_pending = False
+        return request
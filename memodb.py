@@ -1,6 +1,84 @@
 import sqlite3
 from sqlite3 import Error
 import json
+import html
+import queue
+import time
+import itertools
+import bisect
+import threading
+from collections import deque
+from concurrent.futures import Future
+import metrics
+import serverlog
+
+# how many compiled statements each pooled connection holds on to
+STATEMENT_CACHE_SIZE = 64
+# milliseconds a connection waits on a locked database before giving up
+BUSY_TIMEOUT = 5000
+
+# goes up by one for every change to the memos table that gets committed,
+# so anyone holding on to memos can tell when theirs are out of date.
+# it starts from the time we started in microseconds rather than 0, so a version
+# handed out before a restart is always older than anything in the new change log
+memo_version = int(time.time() * 1000000)
+# with several worker processes the version is the memo_revision counter in the database
+# instead, so a version means the same thing in every worker and the memo list at a version
+# is the same everywhere. each change in the log has the revision it gave the table
+shared_versions = False
+# when the version last went up. we can't know about changes from before we started
+memo_version_time = time.time()
+memo_version_lock = threading.Lock()
+# writers hold this from the start of their transaction until their changes are published,
+# so changes go into the log in the order they were committed. the revision watcher takes
+# it too while it publishes what other workers changed
+revision_lock = threading.Lock()
+
+# how many of the latest changes to the memos table are remembered for the change feed
+CHANGE_LOG_SIZE = 10000
+# the latest changes, oldest first. each one is a dict with the version it brought the
+# table to, op ('create', 'update', 'delete' or 'delete_all'), memo_id, content and last_edited_by
+change_log = deque(maxlen=CHANGE_LOG_SIZE)
+# the version the change log starts after. anyone further behind has missed changes we no longer have
+change_log_floor = memo_version
+# functions called with no arguments whenever new changes are added to the log
+change_listeners = set()
+# changes a thread's write has made but not committed yet
+pending_changes = threading.local()
+
+# with several worker processes, each one only hears about its own writes when they're
+# committed. what the others change is found by a thread checking the revision counter
+# this many seconds apart, and published to this process's change log from there
+REVISION_POLL_INTERVAL = 0.1
+
+# most writes one group commit covers, and how many seconds the writer waits
+# for more writes to join a group once it has the first one. with no wait a group
+# is whatever queued up while the last commit was running, which is already plenty
+# under load and costs a lone writer nothing
+GROUP_COMMIT_SIZE = 256
+GROUP_COMMIT_DELAY = 0
+# what goes around the matched words in a search snippet, what marks text cut off
+# either side of it, and about how many words a snippet holds
+SNIPPET_START = '<mark>'
+SNIPPET_END = '</mark>'
+SNIPPET_ELLIPSIS = '...'
+# sqlite marks the matches with these control characters instead, so the memo text around
+# them can be HTML-escaped before they're turned into SNIPPET_START and SNIPPET_END
+SNIPPET_MATCH_START = '\x02'
+SNIPPET_MATCH_END = '\x03'
+SNIPPET_WORDS = 16
+
+# the GroupCommitWriter every write goes through, or None to commit each write on
+# the connection it was made on
+group_writer = None
+
+# sessions nobody has been seen with for this many seconds are deleted, unless a memo
+# was last edited by them. the pruner deletes that many at a time and gives other
+# writes a turn in between
+SESSION_LIFETIME = 30 * 24 * 60 * 60
+SESSION_PRUNE_INTERVAL = 60 * 60
+SESSION_PRUNE_BATCH = 500
+SESSION_PRUNE_PAUSE = 0.05
 
 
 # param db_file: the database we want to connect to
@@ -13,14 +91,493 @@ def create_connection(db_file):
     try:
         conn = sqlite3.connect(db_file)
         conn.execute("PRAGMA foreign_keys = 1")
-        print("Connection to SQLite established")
+        serverlog.debug('Connection to SQLite established.', database=db_file)
 
     except Error as e:
-        print(e)
+        serverlog.error('Failed to connect to SQLite.', database=db_file, error=e)
 
     return conn
 
 
+DB_ERRORS = metrics.Counter('memo_db_errors_total', 'Database statements and commits that raised an error.')
+
+
+# a cursor that adds the time its statements take to the request's "db" stage,
+# and counts the ones that fail. fetching rows is timed too, since that's
+# where sqlite does most of the work for a query
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        return self.timed(super().execute, args)
+
+    def executemany(self, *args):
+        return self.timed(super().executemany, args)
+
+    def fetchone(self):
+        return self.timed(super().fetchone, ())
+
+    def fetchall(self):
+        return self.timed(super().fetchall, ())
+
+    def timed(self, method, args):
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        except Error:
+            DB_ERRORS.inc()
+            raise
+        finally:
+            metrics.add_stage_time('db', time.perf_counter() - started)
+
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        except Error:
+            DB_ERRORS.inc()
+            raise
+        finally:
+            metrics.add_stage_time('db', time.perf_counter() - started)
+
+
+# param db_file: the database we want to connect to
+# return conn: a Connection object that can be shared between threads, or None
+# opens a connection for the pool. WAL lets readers carry on while someone writes,
+# and synchronous=NORMAL only syncs at checkpoints instead of on every commit
+def create_pooled_connection(db_file):
+
+    conn = None
+
+    try:
+        conn = sqlite3.connect(db_file, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE,
+                               factory=TimedConnection)
+        conn.execute("PRAGMA foreign_keys = 1")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA busy_timeout = {}".format(BUSY_TIMEOUT))
+
+    except Error as e:
+        serverlog.error('Failed to connect to SQLite.', database=db_file, error=e)
+        if conn is not None:
+            conn.close()
+            conn = None
+
+    return conn
+
+
+# param db_file: the database we want to connect to
+# param size: how many connections to open
+# return pool: a Queue holding the open connections, or None if any of them failed
+def create_connection_pool(db_file, size):
+    pool = queue.Queue()
+
+    for _ in range(size):
+        conn = create_pooled_connection(db_file)
+        if conn is None:
+            close_connection_pool(pool)
+            return None
+        pool.put(conn)
+
+    serverlog.info('Connection pool to SQLite established.', database=db_file, connections=size)
+    return pool
+
+
+# return conn: a connection from the pool, or None if none came free within timeout seconds
+def get_pooled_connection(pool, timeout=None):
+    conn = None
+
+    try:
+        conn = pool.get(timeout=timeout)
+    except queue.Empty:
+        serverlog.warning('Timed out waiting for a database connection.')
+
+    return conn
+
+
+# hands the connection back to the pool. anything a failed query left
+# uncommitted gets rolled back so the next user starts clean
+def return_pooled_connection(pool, conn):
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+    except Error as e:
+        serverlog.error('Failed to roll back a pooled connection.', error=e)
+
+    pool.put(conn)
+
+
+def close_connection_pool(pool):
+    while not pool.empty():
+        pool.get_nowait().close()
+
+
+def memo_table_version():
+    return memo_version
+
+
+# return: [version, time of the last change] read together
+def memo_table_version_and_time():
+    with memo_version_lock:
+        return [memo_version, memo_version_time]
+
+
+def make_change(op, memo_id=None, content=None, last_edited_by=None):
+    return {'version': None, 'op': op, 'memo_id': memo_id, 'content': content, 'last_edited_by': last_edited_by}
+
+
+# write functions call this for every change they make to the memos table, in the order
+# the statements make them. it only shows up in the change log once the write is committed
+# param revisions: how many revisions the change took, one for every row it touched
+def note_change(op, memo_id=None, content=None, last_edited_by=None, revisions=1):
+    pending_changes.changes.append([make_change(op, memo_id, content, last_edited_by), revisions])
+
+
+def start_pending_changes():
+    pending_changes.changes = []
+
+
+# return: [[change, revisions it took], ...] for the changes noted since start_pending_changes()
+def take_pending_changes():
+    changes = pending_changes.changes
+    pending_changes.changes = []
+    return changes
+
+
+# param noted: what take_pending_changes() returned for a committed transaction
+# param first_revision: in shared mode, the revision the transaction started from. None otherwise
+# return: the changes, each with the revision it gave the table as its version in shared mode
+def number_changes(noted, first_revision):
+    changes = []
+    revision = first_revision
+    for change, revisions in noted:
+        if revision is not None:
+            revision += revisions
+            change['version'] = revision
+        changes.append(change)
+    return changes
+
+
+# call this after committing changes to the memos table, in the order they were committed.
+# each one goes in the change log with the next version (or, in shared mode, the revision it
+# already has), then the listeners hear about it
+# param version: in shared mode, the revision the table is at once these changes are in
+def publish_changes(changes, version=None):
+    global memo_version, memo_version_time, change_log_floor
+
+    if not changes and version is None:
+        return
+
+    with memo_version_lock:
+        for change in changes:
+            if change['version'] is None:
+                change['version'] = memo_version + 1
+            memo_version = change['version']
+            if len(change_log) == CHANGE_LOG_SIZE:
+                change_log_floor = change_log[0]['version']
+            change_log.append(change)
+        if version is not None:
+            memo_version = version
+        memo_version_time = time.time()
+        listeners = list(change_listeners)
+
+    for listener in listeners:
+        listener()
+
+
+# return: [current version, list of changes after version], where the list is None if
+#         the log no longer goes back that far (or version isn't one of ours), so the
+#         caller has to start over from the whole memo list
+def changes_since(version):
+    with memo_version_lock:
+        if version > memo_version:
+            # in shared mode the version can come from a worker that's seen a little more than
+            # this one. the changes after it get here once the revision watcher catches up
+            if shared_versions:
+                return [version, []]
+            return [memo_version, None]
+        if version == memo_version:
+            return [memo_version, []]
+        if version < change_log_floor:
+            return [memo_version, None]
+
+        start = bisect.bisect_right(change_log, version, key=lambda change: change['version'])
+        return [memo_version, list(itertools.islice(change_log, start, None))]
+
+
+# param listener: called with no arguments, from whichever thread committed the changes
+def add_change_listener(listener):
+    with memo_version_lock:
+        change_listeners.add(listener)
+
+
+def remove_change_listener(listener):
+    with memo_version_lock:
+        change_listeners.discard(listener)
+
+
+# one thread owns a connection of its own and makes every write to the database.
+# writes from all the request threads queue up for it, and it runs as many as it
+# can get (up to max_batch, waiting at most max_delay seconds) in one transaction
+# with one commit, so concurrent writers share an fsync instead of fighting over
+# the write lock. each write gets a savepoint, so one that fails is rolled back
+# on its own and the rest of the group still commits
+class GroupCommitWriter:
+    def __init__(self, conn, max_batch=GROUP_COMMIT_SIZE, max_delay=GROUP_COMMIT_DELAY):
+        self.conn = conn
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.writes = queue.Queue()
+        self.commits = 0
+        self.committed_writes = 0
+        self.failed_writes = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # param write: function(cursor, *args) that runs the statements without committing
+    # return: whatever write returned, once the group it was in is committed.
+    #         raises whatever write raised, or whatever failed the commit or publishing its changes
+    def submit(self, write, *args):
+        future = Future()
+        self.writes.put([future, write, args])
+        return future.result()
+
+    def run(self):
+        while True:
+            group = [self.writes.get()]
+            deadline = time.monotonic() + self.max_delay
+
+            while len(group) < self.max_batch:
+                try:
+                    group.append(self.writes.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            try:
+                self.commit_group(group)
+            except Exception as e:
+                self.fail_group(group, e)
+
+    def commit_group(self, group):
+        with revision_lock:
+            self.commit_group_in_order(group)
+
+    def commit_group_in_order(self, group):
+        outcomes = []
+        start_pending_changes()
+
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            first_revision = start_shared_write(cursor)
+
+            for future, write, args in group:
+                cursor.execute("SAVEPOINT group_write")
+                changes_before = len(pending_changes.changes)
+                try:
+                    outcomes.append([future, write(cursor, *args), None])
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO group_write")
+                    # the changes it noted were rolled back with it
+                    del pending_changes.changes[changes_before:]
+                    outcomes.append([future, None, e])
+                cursor.execute("RELEASE group_write")
+
+            last_revision = shared_write_revision(cursor)
+            self.conn.commit()
+
+        except Exception as e:
+            serverlog.error('Failed to commit a group of writes.', error=e)
+            if self.conn.in_transaction:
+                self.conn.rollback()
+            take_pending_changes()
+            self.failed_writes += len(group)
+            for future, _, _ in group:
+                future.set_exception(e)
+            return
+
+        publish_changes(number_changes(take_pending_changes(), first_revision), last_revision)
+
+        self.commits += 1
+        for future, result, error in outcomes:
+            if error is None:
+                self.committed_writes += 1
+                future.set_result(result)
+            else:
+                self.failed_writes += 1
+                future.set_exception(error)
+
+    # for anything that went wrong outside the writes themselves, like publishing the changes
+    # after the commit. every write in the group that hasn't been answered gets the error,
+    # so no submit() waits forever and the writer goes on with the next group
+    def fail_group(self, group, error):
+        serverlog.error('Writer failed to finish a group of writes.', error=error)
+        if self.conn.in_transaction:
+            self.conn.rollback()
+
+        for future, _, _ in group:
+            if not future.done():
+                self.failed_writes += 1
+                future.set_exception(error)
+
+    def statistics(self):
+        return {
+            'commits': self.commits,
+            'writes': self.committed_writes,
+            'failed_writes': self.failed_writes,
+            'writes_per_commit': self.committed_writes / self.commits if self.commits else 0.0,
+            'queued': self.writes.qsize(),
+        }
+
+
+# param since_revision: the revision this process's change log is up to
+# return: [revision the log is up to now, changes to publish], or None if the query failed.
+#         a memo changed more than once only shows up once, as it is now, with its latest revision
+def find_revision_changes(conn, since_revision):
+    changes = get_memo_changes(conn, since_revision, CHANGE_LOG_SIZE)
+    if changes is None:
+        return None
+
+    revision, memo_rows, tombstone_rows = changes
+    # if either list was cut short, stop where it was cut and pick up the rest next time
+    for rows, column in [[memo_rows, 3], [tombstone_rows, 1]]:
+        if len(rows) == CHANGE_LOG_SIZE:
+            revision = min(revision, rows[-1][column])
+
+    found = []
+    for memo_id, content, last_edited_by, memo_revision in memo_rows:
+        if memo_revision <= revision:
+            found.append(make_change('update', memo_id, content, last_edited_by))
+            found[-1]['version'] = memo_revision
+    for memo_id, memo_revision in tombstone_rows:
+        if memo_revision <= revision:
+            found.append(make_change('delete', memo_id))
+            found[-1]['version'] = memo_revision
+    found.sort(key=lambda change: change['version'])
+
+    return [revision, found]
+
+
+# publishes what other workers changed until the change log is up to revision.
+# only call this while holding revision_lock
+def catch_up_revisions(conn, revision):
+    while memo_version < revision:
+        found = find_revision_changes(conn, memo_version)
+        if found is None:
+            raise Error('Could not read the changes other workers made.')
+        publish_changes(found[1], found[0])
+
+
+# in shared mode, with the write lock held: publishes whatever other workers committed
+# before this transaction, so the changes it makes go into the change log after theirs
+# return: the revision the transaction starts from, or None if versions aren't shared
+def start_shared_write(cursor):
+    if not shared_versions:
+        return None
+
+    revision = shared_write_revision(cursor)
+    catch_up_revisions(cursor.connection, revision)
+    return revision
+
+
+# return: the revision the transaction has the table at so far, or None if versions aren't shared
+def shared_write_revision(cursor):
+    if not shared_versions:
+        return None
+
+    cursor.execute("SELECT value FROM memo_revision")
+    return cursor.fetchone()[0]
+
+
+def watch_revisions(conn, interval):
+    while True:
+        time.sleep(interval)
+        latest = get_memo_revision(conn)
+        if latest is not None and latest > memo_version:
+            with revision_lock:
+                try:
+                    catch_up_revisions(conn, latest)
+                except Error as e:
+                    serverlog.error('Failed to catch up with the other workers.', error=e)
+
+
+# starts the thread that brings in changes other processes made to the database.
+# from here on this process's versions are the database's revisions too
+# return: False if its connection couldn't be opened
+def start_revision_watch(db_file, interval=REVISION_POLL_INTERVAL):
+    global shared_versions, memo_version, memo_version_time, change_log_floor
+
+    conn = create_pooled_connection(db_file)
+    if conn is None:
+        return False
+
+    revision = get_memo_revision(conn)
+    if revision is None:
+        conn.close()
+        return False
+
+    with memo_version_lock:
+        shared_versions = True
+        memo_version = revision
+        memo_version_time = time.time()
+        change_log_floor = revision
+
+    watcher = threading.Thread(target=watch_revisions, args=(conn, interval), daemon=True)
+    watcher.start()
+    return True
+
+
+# param max_batch: most writes in one commit, 0 or less leaves every write to commit on its own
+# return: False if the writer's connection couldn't be opened
+def start_group_commit(db_file, max_batch=GROUP_COMMIT_SIZE, max_delay=GROUP_COMMIT_DELAY):
+    global group_writer
+
+    if max_batch <= 0:
+        return True
+
+    conn = create_pooled_connection(db_file)
+    if conn is None:
+        return False
+
+    group_writer = GroupCommitWriter(conn, max_batch, max_delay)
+    return True
+
+
+# runs write(cursor, *args) and commits it, through the group writer if there is one.
+# return: what write returned. raises Error if the write or its commit failed
+def run_write(conn, write, *args):
+    if group_writer is not None:
+        # the writer thread's queries aren't timed as part of any request, so the
+        # whole wait for the commit counts as this request's database time
+        started = time.perf_counter()
+        try:
+            return group_writer.submit(write, *args)
+        finally:
+            metrics.add_stage_time('db', time.perf_counter() - started)
+
+    # without a group writer, writes from different threads take turns on revision_lock
+    with revision_lock:
+        start_pending_changes()
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            first_revision = start_shared_write(cursor)
+            result = write(cursor, *args)
+            last_revision = shared_write_revision(cursor)
+            conn.commit()
+        except Exception:
+            take_pending_changes()
+            conn.rollback()
+            raise
+
+        publish_changes(number_changes(take_pending_changes(), first_revision), last_revision)
+
+    return result
+
+
 # this creates all the tables in the memoSystem database
 # param conn: Connection object
 # param sql_create_statement: CREATE TABLE statement
@@ -30,7 +587,7 @@ def create_table(conn, sql_create_statement):
         cursor.execute(sql_create_statement)
 
     except Error as e:
-        print(e)
+        serverlog.error('Failed to create a table.', error=e)
 
 
 def create_memo_statement():
@@ -38,23 +595,184 @@ def create_memo_statement():
                                 id INTEGER PRIMARY KEY,
                                 content TEXT,
                                 last_edited_by TEXT NOT NULL,
+                                revision INTEGER NOT NULL DEFAULT 0,
                                 FOREIGN KEY (last_edited_by) REFERENCES sessions (id)
                                 );'''
     return memo_table_statement
 
 
+# pages of memos filtered by last_edited_by are read in id order, straight off this index
+def create_memo_index_statement():
+    memo_index_statement = '''CREATE INDEX IF NOT EXISTS memos_last_edited_by
+                              ON memos(last_edited_by, id);'''
+    return memo_index_statement
+
+
+# one row holding the revision the last change to memos got. revisions are stored
+# in the database, so unlike the memo version they carry on across restarts
+def create_revision_statement():
+    revision_table_statement = '''CREATE TABLE IF NOT EXISTS memo_revision(
+                                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                                    value INTEGER NOT NULL
+                                    );'''
+    return revision_table_statement
+
+
+# a deleted memo leaves its id and the revision it was deleted at behind,
+# so clients syncing from before then know to drop it
+def create_tombstone_statement():
+    tombstone_table_statement = '''CREATE TABLE IF NOT EXISTS memo_tombstones(
+                                     memo_id INTEGER PRIMARY KEY,
+                                     revision INTEGER NOT NULL
+                                     );'''
+    return tombstone_table_statement
+
+
+# "what changed after revision N" is a range scan on each of these
+def create_revision_index_statements():
+    memo_revision_index = '''CREATE INDEX IF NOT EXISTS memos_revision
+                             ON memos(revision);'''
+    tombstone_revision_index = '''CREATE INDEX IF NOT EXISTS memo_tombstones_revision
+                                  ON memo_tombstones(revision);'''
+    return [memo_revision_index, tombstone_revision_index]
+
+
+# every insert, update and delete on memos takes the next revision, in the same
+# transaction as the change. a new memo that reuses a deleted memo's id replaces its tombstone
+def create_revision_trigger_statements():
+    insert_trigger = '''CREATE TRIGGER IF NOT EXISTS memos_revision_insert AFTER INSERT ON memos BEGIN
+                            UPDATE memo_revision SET value = value + 1;
+                            UPDATE memos SET revision = (SELECT value FROM memo_revision) WHERE id = new.id;
+                            DELETE FROM memo_tombstones WHERE memo_id = new.id;
+                        END;'''
+    update_trigger = '''CREATE TRIGGER IF NOT EXISTS memos_revision_update
+                        AFTER UPDATE OF content, last_edited_by ON memos BEGIN
+                            UPDATE memo_revision SET value = value + 1;
+                            UPDATE memos SET revision = (SELECT value FROM memo_revision) WHERE id = new.id;
+                        END;'''
+    delete_trigger = '''CREATE TRIGGER IF NOT EXISTS memos_revision_delete AFTER DELETE ON memos BEGIN
+                            UPDATE memo_revision SET value = value + 1;
+                            INSERT OR REPLACE INTO memo_tombstones(memo_id, revision)
+                            SELECT old.id, value FROM memo_revision;
+                        END;'''
+    return [insert_trigger, update_trigger, delete_trigger]
+
+
+# memos tables from before revisions existed get the column added, and each memo
+# already there gets a revision of its own so a sync from revision 0 sees all of them.
+# then the revision counter starts from the biggest revision in the table
+def start_memo_revisions(conn):
+    try:
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA table_info(memos)")
+        if 'revision' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE memos ADD COLUMN revision INTEGER NOT NULL DEFAULT 0")
+            cursor.execute("UPDATE memos SET revision = id")
+
+        cursor.execute('''INSERT OR IGNORE INTO memo_revision(id, value)
+                          SELECT 0, COALESCE(MAX(revision), 0) FROM memos''')
+        conn.commit()
+
+    except Error as e:
+        serverlog.error('Failed to set up memo revisions.', error=e)
+        conn.rollback()
+
+
+# full-text index over memo content. it's an external content table, so it holds
+# only the index and reads the text itself back out of memos
+def create_memo_search_statement():
+    memo_search_statement = '''CREATE VIRTUAL TABLE IF NOT EXISTS memos_search
+                               USING fts5(content, content='memos', content_rowid='id');'''
+    return memo_search_statement
+
+
+# these keep memos_search in step with every insert, update and delete on memos,
+# inside the same transaction as the change itself
+def create_memo_search_trigger_statements():
+    insert_trigger = '''CREATE TRIGGER IF NOT EXISTS memos_search_insert AFTER INSERT ON memos BEGIN
+                            INSERT INTO memos_search(rowid, content) VALUES (new.id, new.content);
+                        END;'''
+    delete_trigger = '''CREATE TRIGGER IF NOT EXISTS memos_search_delete AFTER DELETE ON memos BEGIN
+                            INSERT INTO memos_search(memos_search, rowid, content)
+                            VALUES ('delete', old.id, old.content);
+                        END;'''
+    update_trigger = '''CREATE TRIGGER IF NOT EXISTS memos_search_update AFTER UPDATE OF content ON memos BEGIN
+                            INSERT INTO memos_search(memos_search, rowid, content)
+                            VALUES ('delete', old.id, old.content);
+                            INSERT INTO memos_search(rowid, content) VALUES (new.id, new.content);
+                        END;'''
+    return [insert_trigger, delete_trigger, update_trigger]
+
+
+def table_exists(conn, table_name):
+    exists = False
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (table_name,))
+        exists = cursor.fetchone() is not None
+
+    except Error as e:
+        serverlog.error('Failed to look up a table.', table=table_name, error=e)
+
+    return exists
+
+
+# fills memos_search from scratch with the memos that are already there
+def rebuild_search_index(conn):
+    try:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO memos_search(memos_search) VALUES ('rebuild')")
+        conn.commit()
+
+    except Error as e:
+        serverlog.error('Failed to build the memo search index.', error=e)
+        conn.rollback()
+
+
+# created and last_seen are unix times in seconds. sessions from before they were
+# kept have 0 for created, and are last seen when the columns were added
 def create_sessions_statement():
     session_table_statement = '''CREATE TABLE IF NOT EXISTS sessions(
-                                    id TEXT PRIMARY KEY
+                                    id TEXT PRIMARY KEY,
+                                    created INTEGER NOT NULL DEFAULT 0,
+                                    last_seen INTEGER NOT NULL DEFAULT 0
                                     );'''
     return session_table_statement
 
 
+# the pruner walks the sessions in last_seen order, straight off this index
+def create_session_index_statement():
+    session_index_statement = '''CREATE INDEX IF NOT EXISTS sessions_last_seen
+                                 ON sessions(last_seen, id);'''
+    return session_index_statement
+
+
+# sessions tables from before the timestamps existed get the columns added. their sessions
+# start their lifetime now, rather than all expiring at once
+def start_session_timestamps(conn):
+    try:
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA table_info(sessions)")
+        columns = [column[1] for column in cursor.fetchall()]
+        for column in ['created', 'last_seen']:
+            if column not in columns:
+                cursor.execute("ALTER TABLE sessions ADD COLUMN {} INTEGER NOT NULL DEFAULT 0".format(column))
+        if 'last_seen' not in columns:
+            cursor.execute("UPDATE sessions SET last_seen = ?", (int(time.time()),))
+        conn.commit()
+
+    except Error as e:
+        serverlog.error('Failed to add session timestamps.', error=e)
+        conn.rollback()
+
+
+# return: [(last_seen,)] if the session has a row, [] if it doesn't, or None if the query failed
 def get_session_by_id(conn, session_id):
 
     rows = None
 
-    select_statement = '''SELECT * FROM sessions 
+    select_statement = '''SELECT last_seen FROM sessions
                           WHERE id = ?'''
     try:
         cursor = conn.cursor()
@@ -62,8 +780,7 @@ def get_session_by_id(conn, session_id):
         rows = cursor.fetchall()
 
     except Error as e:
-        print("Failed to query sessions table in database.\n")
-        print(e)
+        serverlog.error('Failed to query sessions table in database.', error=e)
 
     return rows
 
@@ -81,128 +798,453 @@ def get_memo_by_id(conn, memo_id):
         rows = cursor.fetchall()
 
     except Error as e:
-        print("Failed to query memo table in database\n")
-        print(e)
+        serverlog.error('Failed to query memo table in database.', error=e)
 
     return rows
 
 
+# the whole memo table and the revision it's at, read in one transaction so they match exactly
+# return: [revision, rows of (id, content, last_edited_by)], or None if the query failed
+def get_all_memos_and_revision(conn):
+
+    result = None
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        cursor.execute("SELECT value FROM memo_revision")
+        revision = cursor.fetchone()[0]
+        cursor.execute("SELECT id, content, last_edited_by FROM memos")
+        result = [revision, cursor.fetchall()]
+        conn.commit()
+
+    except Error as e:
+        serverlog.error('Fetching memos failed.', error=e)
+
+    return result
+
+
 def get_all_memos(conn):
 
     rows = None
 
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM memos")
+        cursor.execute("SELECT id, content, last_edited_by FROM memos")
         rows = cursor.fetchall()
 
     except Error as e:
-        print("Fetching memos failed.")
-        print(e)
+        serverlog.error('Fetching memos failed.', error=e)
 
     return rows
 
 
-def add_memo(conn, content, session_id):
-    last_row = None
+# param after: only memos with an id bigger than this, so the next page picks up where the last one stopped
+# param limit: how many memos at most
+# param last_edited_by: if not None, only memos this session last edited
+def get_memos_page(conn, after, limit, last_edited_by=None):
 
+    rows = None
+
+    if last_edited_by is None:
+        select_statement = '''SELECT id, content, last_edited_by FROM memos
+                              WHERE id > ?
+                              ORDER BY id
+                              LIMIT ?'''
+        parameters = (after, limit)
+    else:
+        select_statement = '''SELECT id, content, last_edited_by FROM memos
+                              WHERE last_edited_by = ? AND id > ?
+                              ORDER BY id
+                              LIMIT ?'''
+        parameters = (last_edited_by, after, limit)
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute(select_statement, parameters)
+        rows = cursor.fetchall()
+
+    except Error as e:
+        serverlog.error('Fetching a page of memos failed.', error=e)
+
+    return rows
+
+
+def insert_memo(cursor, content, session_id):
+    insert_session(cursor, session_id)
     insert_statement = "INSERT INTO memos(content, last_edited_by) VALUES(?,?)"
+    cursor.execute(insert_statement, (content, session_id))
+    note_change('create', cursor.lastrowid, content, session_id)
+    return cursor.lastrowid
+
+
+# return: the revision the last change to memos got, or None if the query failed
+def get_memo_revision(conn):
+
+    revision = None
+
     try:
         cursor = conn.cursor()
-        cursor.execute(insert_statement, (content, session_id))
-        conn.commit()
-        last_row = cursor.lastrowid
+        cursor.execute("SELECT value FROM memo_revision")
+        revision = cursor.fetchone()[0]
+
+    except Error as e:
+        serverlog.error('Fetching the memo revision failed.', error=e)
+
+    return revision
+
+
+# param since_revision: only changes after this revision
+# param limit: most memos and most tombstones to return (so up to twice this many rows)
+# return: [latest revision, memo rows (id, content, last_edited_by, revision), tombstone rows
+#         (memo_id, revision)], both in revision order and neither going past the latest revision
+def get_memo_changes(conn, since_revision, limit):
+
+    changes = None
+
+    try:
+        cursor = conn.cursor()
+        # read the latest revision first. anything that changes after this shows up in the next sync
+        cursor.execute("SELECT value FROM memo_revision")
+        revision = cursor.fetchone()[0]
+
+        cursor.execute('''SELECT id, content, last_edited_by, revision FROM memos
+                          WHERE revision > ? AND revision <= ?
+                          ORDER BY revision
+                          LIMIT ?''', (since_revision, revision, limit))
+        memo_rows = cursor.fetchall()
+
+        cursor.execute('''SELECT memo_id, revision FROM memo_tombstones
+                          WHERE revision > ? AND revision <= ?
+                          ORDER BY revision
+                          LIMIT ?''', (since_revision, revision, limit))
+        tombstone_rows = cursor.fetchall()
+
+        changes = [revision, memo_rows, tombstone_rows]
 
     except Error as e:
-        print("Failed to add memo to database.\n")
-        print(e)
+        serverlog.error('Fetching memo changes failed.', error=e)
+
+    return changes
+
+
+# turns what someone typed into an FTS5 query that matches memos containing every word.
+# each word is quoted so characters like - or : are searched for rather than read as
+# query syntax. a word ending in * matches any word it's the start of
+# return: the query, or None if there are no words to search for
+def search_expression(text):
+    phrases = []
+
+    for word in text.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if word:
+            phrase = '"{}"'.format(word.replace('"', '""'))
+            if prefix:
+                phrase = '{}*'.format(phrase)
+            phrases.append(phrase)
+
+    if not phrases:
+        return None
+    return ' '.join(phrases)
+
+
+# param expression: an FTS5 query, see search_expression
+# param offset: how many of the best matches to skip
+# return: rows of (id, content, last_edited_by, snippet), best match first.
+#         the snippet is HTML: escaped memo text with the matches in <mark> tags
+def search_memos(conn, expression, offset, limit):
+
+    rows = None
+
+    select_statement = '''SELECT memos.id, memos.content, memos.last_edited_by,
+                                 snippet(memos_search, 0, ?, ?, ?, ?)
+                          FROM memos_search JOIN memos ON memos.id = memos_search.rowid
+                          WHERE memos_search MATCH ?
+                          ORDER BY memos_search.rank, memos.id
+                          LIMIT ? OFFSET ?'''
+    parameters = (SNIPPET_MATCH_START, SNIPPET_MATCH_END, SNIPPET_ELLIPSIS, SNIPPET_WORDS, expression, limit, offset)
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute(select_statement, parameters)
+        rows = [row[:3] + (highlight_snippet(row[3]),) for row in cursor.fetchall()]
+
+    except Error as e:
+        serverlog.error('Searching memos failed.', error=e)
+
+    return rows
+
+
+# escapes the memo text, so showing the snippet as HTML can't run anything a memo holds,
+# then marks the matches
+def highlight_snippet(snippet):
+    escaped = html.escape(snippet)
+    return escaped.replace(SNIPPET_MATCH_START, SNIPPET_START).replace(SNIPPET_MATCH_END, SNIPPET_END)
+
+
+def add_memo(conn, content, session_id):
+    last_row = None
+
+    try:
+        last_row = run_write(conn, insert_memo, content, session_id)
+
+    except Error as e:
+        serverlog.error('Failed to add memo to database.', error=e)
 
     return last_row
 
 
+# param operations: list of [op, memo id, content] where op is 'create', 'update' or 'delete'
+#                   (memo id is ignored for create, content for delete)
+# return: a list with one entry per operation: the new memo's id for a create, the memo id for an
+#         update or delete, or None if that memo didn't exist. None instead of a list if the batch failed
+# everything happens in one transaction with one commit, and each kind of statement goes through
+# executemany. results match running the operations one at a time in order
+def apply_memo_batch(conn, session_id, operations):
+    results = None
+
+    try:
+        results = run_write(conn, write_memo_batch, session_id, operations)
+
+    except Error as e:
+        serverlog.error('Failed to apply memo batch.', error=e)
+
+    return results
+
+
+# runs inside a transaction that already holds the write lock, so the ids we read can't change under us
+def write_memo_batch(cursor, session_id, operations):
+    referenced = list({memo_id for op, memo_id, _ in operations if op != 'create'})
+    existing = set()
+    # stay well under sqlite's limit on ? parameters per statement
+    for start in range(0, len(referenced), 500):
+        chunk = referenced[start:start + 500]
+        select_statement = "SELECT id FROM memos WHERE id IN ({})".format(','.join('?' * len(chunk)))
+        cursor.execute(select_statement, chunk)
+        existing.update(row[0] for row in cursor.fetchall())
+
+    # with the write lock held, sqlite gives each new row the next id after the biggest one
+    cursor.execute("SELECT COALESCE(MAX(id), 0) FROM memos")
+    next_id = cursor.fetchone()[0] + 1
+
+    inserts = []
+    updates = []
+    deletes = []
+    results = []
+    for op, memo_id, content in operations:
+        if op == 'create':
+            inserts.append((content, session_id))
+            results.append(next_id)
+            # later operations in the batch can update or delete it. the inserts run first, so it's there for them
+            existing.add(next_id)
+            next_id += 1
+
+        elif memo_id in existing:
+            if op == 'update':
+                updates.append((content, session_id, memo_id))
+            else:
+                deletes.append((memo_id,))
+                # anything after this in the batch won't find it
+                existing.discard(memo_id)
+            results.append(memo_id)
+
+        else:
+            results.append(None)
+
+    if inserts or updates or deletes:
+        insert_session(cursor, session_id)
+
+    # an update of a memo that's deleted later in the batch ends up deleted either way,
+    # so running all the updates before all the deletes gives the same table
+    cursor.executemany("INSERT INTO memos(content, last_edited_by) VALUES(?,?)", inserts)
+    cursor.executemany("UPDATE memos SET content = ?, last_edited_by = ? WHERE id = ?", updates)
+    cursor.executemany("DELETE FROM memos WHERE id = ?", deletes)
+
+    # the changes go in the order the statements made them, which is the order they took revisions in
+    first_id = next_id - len(inserts)
+    for offset, (content, _) in enumerate(inserts):
+        note_change('create', first_id + offset, content, session_id)
+    for content, _, memo_id in updates:
+        note_change('update', memo_id, content, session_id)
+    for (memo_id,) in deletes:
+        note_change('delete', memo_id)
+
+    return results
+
+
+# a session gets its row when it's handed out, or with signed cookies only once it writes
+# something, since memos have to point at one. every write it makes after that moves its last_seen up
+def insert_session(cursor, session_id):
+    now = int(time.time())
+    insert_statement = '''INSERT INTO sessions(id, created, last_seen) VALUES(?,?,?)
+                          ON CONFLICT(id) DO UPDATE SET last_seen = excluded.last_seen'''
+    cursor.execute(insert_statement, (session_id, now, now))
+    return cursor.lastrowid
+
+
 def add_session(conn, session_id):
     last_row = None
 
-    insert_statement = "INSERT INTO sessions(id) VALUES(?)"
     try:
-        cursor = conn.cursor()
-        cursor.execute(insert_statement, (session_id,))
-        conn.commit()
-        last_row = cursor.lastrowid
+        last_row = run_write(conn, insert_session, session_id)
 
     except Error as e:
-        print("Failed to add session to database.\n")
-        print(e)
+        serverlog.error('Failed to add session to database.', error=e)
 
     return last_row
 
 
-def update_memo_by_id(conn, memo_id, session_id, content):
-    success = 0
-
+def write_memo_update(cursor, memo_id, session_id, content):
+    insert_session(cursor, session_id)
     update_statement = '''UPDATE memos
                           SET content = ?, last_edited_by = ?
                           WHERE id = ?'''
+    cursor.execute(update_statement, (content, session_id, memo_id))
+    if cursor.rowcount:
+        note_change('update', memo_id, content, session_id)
+
+
+def update_memo_by_id(conn, memo_id, session_id, content):
+    success = 0
+
     try:
-        cursor = conn.cursor()
-        cursor.execute(update_statement, (content, session_id, memo_id))
-        conn.commit()
+        run_write(conn, write_memo_update, memo_id, session_id, content)
         success = 1
     except Error as e:
-        print("Failed to update memos")
-        print(e)
+        serverlog.error('Failed to update memos.', error=e)
 
     return success
 
 
-def delete_memo_by_id(conn, memo_id):
+def write_memo_delete(cursor, memo_id, session_id):
+    delete_statement = "DELETE FROM memos WHERE id = ?"
+    cursor.execute(delete_statement, (memo_id,))
+    if cursor.rowcount:
+        note_change('delete', memo_id)
+        insert_session(cursor, session_id)
+
+
+# param session_id: the session doing the deleting. it counts as a write it made
+def delete_memo_by_id(conn, memo_id, session_id):
     success = 0
 
-    delete_statement = "DELETE FROM memos WHERE id = ?"
     try:
-        cursor = conn.cursor()
-        cursor.execute(delete_statement, (memo_id,))
-        conn.commit()
+        run_write(conn, write_memo_delete, memo_id, session_id)
         success = 1
     except Error as e:
-        print("Failed to delete memo from database.\n")
-        print(e)
+        serverlog.error('Failed to delete memo from database.', error=e)
 
     return success
 
 
+def write_session_delete(cursor, session_id):
+    delete_statement = "DELETE FROM sessions WHERE id = ?"
+    cursor.execute(delete_statement, (session_id,))
+
+
 def delete_session_by_id(conn, session_id):
     success = 0
 
-    delete_statement = "DELETE FROM memos WHERE id = ?"
     try:
-        cursor = conn.cursor()
-        cursor.execute(delete_statement, (session_id,))
-        conn.commit()
+        run_write(conn, write_session_delete, session_id)
         success = 1
     except Error as e:
-        print("Failed to delete session from database.\n")
-        print(e)
+        serverlog.error('Failed to delete session from database.', error=e)
 
     return success
 
 
-def delete_all_memos(conn):
+# param cutoff: sessions last seen before this unix time are expired
+# param after: [last_seen, id] of the last session the previous batch looked at
+# return: [last_seen, id] of the last session this batch looked at, or None if it was the
+#         last batch, and how many sessions were deleted. sessions a memo was last edited by
+#         are skipped, since the memo still points at them
+def write_session_prune(cursor, cutoff, after, batch_size):
+    select_statement = '''SELECT last_seen, id FROM sessions
+                          WHERE last_seen < ? AND (last_seen, id) > (?, ?)
+                          ORDER BY last_seen, id
+                          LIMIT ?'''
+    cursor.execute(select_statement, (cutoff, after[0], after[1], batch_size))
+    expired = cursor.fetchall()
+
+    delete_statement = '''DELETE FROM sessions
+                          WHERE id = ? AND NOT EXISTS (SELECT 1 FROM memos WHERE last_edited_by = ?)'''
+    cursor.executemany(delete_statement, [(session_id, session_id) for _, session_id in expired])
+
+    last = None
+    if len(expired) == batch_size:
+        last = list(expired[-1])
+    return [last, max(cursor.rowcount, 0)]
+
+
+# deletes every expired session, a batch per transaction
+# return: how many sessions were deleted
+def prune_sessions(conn, lifetime=SESSION_LIFETIME, batch_size=SESSION_PRUNE_BATCH):
+    cutoff = int(time.time() - lifetime)
+    after = [-1, '']
+    pruned = 0
+
+    try:
+        while after is not None:
+            after, deleted = run_write(conn, write_session_prune, cutoff, after, batch_size)
+            pruned += deleted
+            time.sleep(SESSION_PRUNE_PAUSE)
+
+    except Error as e:
+        serverlog.error('Failed to prune sessions.', error=e)
+
+    return pruned
+
+
+def prune_sessions_forever(conn, lifetime, interval):
+    while True:
+        pruned = prune_sessions(conn, lifetime)
+        if pruned:
+            serverlog.info('pruned expired sessions', sessions=pruned)
+        time.sleep(interval)
+
+
+# starts the thread that deletes expired sessions every interval seconds
+# return: False if its connection couldn't be opened
+def start_session_pruner(db_file, lifetime=SESSION_LIFETIME, interval=SESSION_PRUNE_INTERVAL):
+    conn = create_pooled_connection(db_file)
+    if conn is None:
+        return False
+
+    pruner = threading.Thread(target=prune_sessions_forever, args=(conn, lifetime, interval), daemon=True)
+    pruner.start()
+    return True
+
+
+def write_delete_all_memos(cursor):
     delete_statement = "DELETE FROM memos"
+    cursor.execute(delete_statement)
+    if cursor.rowcount:
+        note_change('delete_all', revisions=cursor.rowcount)
+
+
+def delete_all_memos(conn):
     try:
-        cursor = conn.cursor()
-        cursor.execute(delete_statement)
-        conn.commit()
+        run_write(conn, write_delete_all_memos)
     except Error as e:
-        print("Failed to delete all memos.\n")
-        print(e)
+        serverlog.error('Failed to delete all memos.', error=e)
+
+
+def rows_to_dicts(keys, values):
+    return [dict(zip(keys, value)) for value in values]
+
+
+# param indent: None gives the most compact encoding, with no whitespace at all
+def to_json(data, indent=4):
+    started = time.perf_counter()
+    separators = None
+    if indent is None:
+        separators = (',', ':')
+    encoded = json.dumps(data, indent=indent, separators=separators)
+    metrics.add_stage_time('serialize', time.perf_counter() - started)
+    return encoded
 
 
-def to_dict_json(keys, values):
-    data = {}
-    all_data = []
-    for value in values:
-        for _ in value:
-            data = dict(zip(keys, value))
-        all_data.append(data)
-    return json.dumps(all_data, indent=4)
+def to_dict_json(keys, values, indent=4):
+    return to_json(rows_to_dicts(keys, values), indent)
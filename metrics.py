@@ -0,0 +1,148 @@
+import bisect
+import threading
+
+# upper bounds in seconds for latency histograms, from half a millisecond to 10 seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# every metric made, in the order they were made, so /metrics can list them all
+registry = []
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+# {method="GET",status="200"}, or nothing when there are no labels
+def format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(name, escape_label_value(value)) for name, value in pairs))
+
+
+# a number that only goes up, kept separately for every combination of label values.
+# updates take one short lock, so this is cheap enough to call for every request
+class Counter:
+    metric_type = 'counter'
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        # label values -> current value
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} {}'.format(self.name, self.metric_type)]
+        with self.lock:
+            values = sorted(self.values.items())
+        # a metric without labels still shows up before it's ever been touched
+        if not values and not self.label_names:
+            values = [((), 0)]
+        for label_values, value in values:
+            lines.append('{}{} {}'.format(self.name, format_labels(self.label_names, label_values), value))
+        return lines
+
+
+# a number that goes up and down, like how many connections are open right now
+class Gauge(Counter):
+    metric_type = 'gauge'
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+
+# counts observations into buckets by size, plus their count and sum, for every
+# combination of label values. buckets are stored one count each and only added
+# up into Prometheus's cumulative buckets when /metrics is read
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # label values -> [count in each bucket, then one for past the last bucket, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            self.add(value, label_values)
+
+    # param totals: {label value: observed value}, for a histogram with a single label.
+    # they all go in under one lock, which is cheaper than observing them one at a time
+    def observe_by_label(self, totals):
+        with self.lock:
+            for label_value, value in totals.items():
+                self.add(value, (label_value,))
+
+    # only call this while holding the lock
+    def add(self, value, label_values):
+        counts = self.values.get(label_values)
+        if counts is None:
+            counts = [0] * (len(self.buckets) + 1) + [0.0]
+            self.values[label_values] = counts
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            values = sorted((label_values, list(counts)) for label_values, counts in self.values.items())
+
+        for label_values, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = format_labels(self.label_names, label_values, [('le', bound)])
+                lines.append('{}_bucket{} {}'.format(self.name, labels, cumulative))
+            labels = format_labels(self.label_names, label_values)
+            lines.append('{}_sum{} {}'.format(self.name, labels, counts[-1]))
+            lines.append('{}_count{} {}'.format(self.name, labels, cumulative))
+
+        return lines
+
+
+# the Prometheus text format for every metric there is
+def render_all():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# how long each part of answering a request took. some stages happen more than once per
+# request (a request can make several queries), so the time is added up over the whole
+# request and observed once when it's been answered
+REQUEST_STAGE_SECONDS = Histogram('memo_request_stage_seconds',
+                                  'Time spent in each stage of handling a request.', ['stage'])
+
+# {stage: seconds so far} for the request the current thread is working on, or None
+request_stages = threading.local()
+
+
+# param totals: the dict this thread's stage times get added to until stop_stages()
+def start_stages(totals):
+    request_stages.totals = totals
+
+
+def stop_stages():
+    request_stages.totals = None
+
+
+# time spent outside of a request (like the group commit writer's own queries) isn't counted
+def add_stage_time(stage, seconds):
+    totals = getattr(request_stages, 'totals', None)
+    if totals is not None:
+        totals[stage] = totals.get(stage, 0.0) + seconds
@@ -1,87 +1,407 @@
 import sys
 import socket
 import threading
+import queue
+import select
+import selectors
+import argparse
+import asyncio
+import concurrent.futures
 import memodb
+import httpparser
+import cache
+import staticfiles
+import metrics
+import serverlog
+import sessiontokens
 import uuid
 import json
 import os
+import signal
+import time
+import gzip
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import parse_qsl
 
 HOST = ''
 PORT = 8265
 FORMAT = 'utf-8'
 ADDRESS = (HOST, PORT)
 
+DATABASE = 'memoSystem.db'
+# static files are served from here
+DOCUMENT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'files-distribution')
+# seconds between checks of the document root for new or changed files. 0 never checks
+STATIC_REFRESH_INTERVAL = 5
+# bytes of ready-made static file responses we keep in memory. 0 turns the cache off
+FILE_CACHE_BYTES = 8388608
+# files bigger than this are always streamed from disk instead
+MAX_CACHED_FILE_SIZE = 262144
+FILE_CACHE = cache.LRUCache(max_bytes=FILE_CACHE_BYTES)
+# connections opened up front and shared by every request
+DATABASE_POOL_SIZE = 16
+# seconds a request waits for a free database connection before we answer 503
+DATABASE_POOL_TIMEOUT = 5
+# the pool itself, opened in main()
+DATABASE_POOL = None
+
 HTTP_VERSION = 'HTTP/1.1'
 HTTP_SUCCESS = '200 OK'
 HTTP_CREATED = '201 Created'
-
-
-def request_to_dict(request):
-    # remove leading and trailing newlines
-    request = request.strip()
-    # replace the newlines in the string with ": " to make it easier to parse
-    request = request.replace("\r\n", ": ")
-    request = request.split(": ")
-
-    # now turn the list into dict
-    i = iter(request)
-    request_dict = dict(zip(i, i))
-    return request_dict
+HTTP_PARTIAL_CONTENT = '206 Partial Content'
+
+# how incoming connections get handed off. 'threads' starts a new thread for
+# every connection, 'pool' hands them to a fixed number of worker threads and
+# 'async' serves every connection from one asyncio event loop
+SERVER_MODE = 'threads'
+# number of worker threads in pool mode
+POOL_SIZE = 16
+# how many accepted connections can wait for a worker before we start turning them away
+ACCEPT_BACKLOG = 128
+# seconds a client should wait before retrying after a 503
+RETRY_AFTER = 1
+# threads the asyncio server uses for database and file work
+EXECUTOR_THREADS = 4
+
+# with --workers, that many processes each serve connections in the chosen mode. each
+# one binds the port itself with SO_REUSEPORT and the kernel spreads connections between them
+REUSE_PORT = False
+# a worker that dies sooner than this many seconds after starting waits this long before
+# it's restarted, so one that can't start at all doesn't get restarted in a tight loop
+WORKER_RESTART_DELAY = 1
+# seconds workers get to finish what they're doing once told to stop, before they're killed
+WORKER_SHUTDOWN_TIMEOUT = 10
+
+# how many bytes we try to read off the socket at a time
+RECV_SIZE = 65536
+# seconds an idle keep-alive connection stays open between requests
+KEEP_ALIVE_TIMEOUT = 5
+# requests a single connection can make before we close it
+MAX_KEEP_ALIVE_REQUESTS = 100
+# biggest request line plus headers, and biggest body, we'll accept
+MAX_HEADER_SIZE = httpparser.MAX_HEADER_SIZE
+MAX_BODY_SIZE = httpparser.MAX_BODY_SIZE
+# interim response for clients that send "Expect: 100-continue"
+CONTINUE_RESPONSE = '{} 100 Continue\r\n\r\n'.format(HTTP_VERSION).encode(FORMAT)
+
+# responses are [header block, body bytes], or [header block, open file, offset, byte count]
+# for files sent with sendfile. the header block is the status line and headers as bytes,
+# each ending in CRLF. the blank line after them goes out with the body, in the same sendmsg,
+# so neither is ever copied into one buffer with the other
+CRLF = b'\r\n'
+# header lines every response of their kind carries, encoded once
+JSON_HEADERS = b'Content-Type: application/json\r\nAccess-Control-Allow-Origin: *\r\n' \
+               b'Access-Control-Allow-Origin: localhost:8265/\r\n'
+NO_CONTENT_HEADERS = b'Content-Length: 0\r\n'
+VARY_HEADER = b'Vary: Accept-Encoding\r\n'
+GZIP_HEADER = b'Content-Encoding: gzip\r\n'
+NO_STORE_HEADER = b'Cache-Control: no-store\r\n'
+ACCEPT_RANGES_HEADER = b'Accept-Ranges: bytes\r\n'
+CONNECTION_CLOSE_HEADER = b'Connection: close\r\n'
+
+# seconds a long-poll for memo changes waits before answering that nothing changed
+LONG_POLL_TIMEOUT = 25
+# seconds between comments sent down a quiet event stream, so we notice when the client is gone
+EVENT_STREAM_HEARTBEAT = 15
+# seconds an event stream stays open. EventSource reconnects on its own and picks up where it left off
+EVENT_STREAM_DURATION = 300
+# milliseconds EventSource should wait before reconnecting
+EVENT_STREAM_RETRY = 3000
+
+# request paths are reported under one of these, or under /api/memos/{id} or static,
+# so every memo and file doesn't get a time series of its own
+METRIC_ROUTES = ('/api/memos', '/api/memos/batch', '/api/memos/search', '/api/memos/changes', '/api/stats',
+                 '/metrics')
+# any other method the client sends is counted as 'other', so made-up methods can't add series
+METRIC_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+REQUESTS = metrics.Counter('memo_requests_total', 'Requests answered.', ['method', 'route', 'status'])
+REQUEST_SECONDS = metrics.Histogram('memo_request_duration_seconds',
+                                    'Time from the first byte of a request to the end of its response.', ['route'])
+ACTIVE_CONNECTIONS = metrics.Gauge('memo_active_connections', 'Client connections open right now.')
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# counters for the worker pool, guarded by pool_stats_lock
+pool_stats = {'accepted': 0, 'rejected': 0, 'change_feeds_rejected': 0}
+pool_stats_lock = threading.Lock()
+# connections waiting for a worker, when running in pool mode
+CONNECTION_QUEUE = None
+# in pool mode a keep-alive connection with nothing to read is handed to the idle connection
+# watcher instead of holding a worker while it waits. [connections to start watching, wakeup socket]
+IDLE_CONNECTIONS = None
+
+# how many session ids we remember, and for how many seconds, before asking the database again
+SESSION_CACHE_SIZE = 10000
+SESSION_CACHE_TTL = 300
+# session ids we know are in the sessions table -> when they were last seen
+SESSION_CACHE = cache.LRUCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+# seconds after a session was last seen that its cookie stops being accepted, from --session-lifetime
+SESSION_LIFETIME = memodb.SESSION_LIFETIME
+# a session that only reads has its last_seen moved up once it's this old, so it doesn't
+# expire while it's still being used
+SESSION_REFRESH_AGE = 24 * 60 * 60
+# seconds between checks for idle connections that have timed out
+IDLE_SWEEP_INTERVAL = 0.5
+# in pool mode a long-poll or event stream holds its worker for as long as it waits, so only
+# this many can wait at once and the rest get a 503. None when they don't use up a worker
+CHANGE_FEED_SLOTS = None
+
+# set once per run and baked into the memo list ETag, since the memo table
+# version starts over whenever the server restarts. workers share their supervisor's
+SERVER_INSTANCE = uuid.uuid4().hex[:8]
+# the memo list changes all the time, so clients must check back every time (cheap with an ETag)
+API_CACHE_CONTROL = 'no-cache'
+API_CACHE_HEADER = 'Cache-Control: {}\r\n'.format(API_CACHE_CONTROL).encode(FORMAT)
+# how long browsers can reuse a static file before checking back with us
+STATIC_CACHE_CONTROL = 'public, max-age=60'
+
+MEMO_KEYS = ['memo_id', 'content', 'last_edited_by']
+SEARCH_RESULT_KEYS = ['memo_id', 'content', 'last_edited_by', 'snippet']
+SYNC_KEYS = ['memo_id', 'content', 'last_edited_by', 'revision']
+# gzip level for compressed responses, 1 (fastest) to 9 (smallest). 0 never compresses
+GZIP_LEVEL = 6
+# bodies smaller than this aren't worth compressing
+GZIP_MIN_SIZE = 1024
+# content types that shrink when compressed. images are already compressed
+COMPRESSIBLE_TYPES = ('text/', 'application/json')
+
+# most operations a single POST /api/memos/batch can carry
+MAX_BATCH_OPERATIONS = 10000
+
+# memos per page when ?limit= isn't given, and the most we'll send in one page
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# indent for the memo list JSON. None sends it compact, without any whitespace
+MEMO_JSON_INDENT = 4
+# [memo table version, encoded memo list, ETag, Last-Modified, gzipped memo list or None]
+# from the last time we built it
+memo_list_cache = [None, None, None, None, None]
+memo_list_stats = {'hits': 0, 'rebuilds': 0}
+memo_list_stats_lock = threading.Lock()
+# b'HTTP/1.1 200 OK\r\n' for each status, and the Connection and Keep-Alive lines for each
+# number of requests a connection has left, encoded the first time they're needed
+status_lines = {}
+keep_alive_headers = {}
+
+
+# param status: like '200 OK'
+def status_line(status):
+    line = status_lines.get(status)
+    if line is None:
+        line = '{} {}\r\n'.format(HTTP_VERSION, status).encode(FORMAT)
+        status_lines[status] = line
+    return line
+
+
+def header_line(name, value):
+    return '{}: {}\r\n'.format(name, value).encode(FORMAT)
+
+
+# the error responses never change, so they're only built once. nothing changes a
+# response once it's built, so handing out the same one every time is safe
+def empty_response(status):
+    return [status_line(status) + NO_CONTENT_HEADERS, b'']
 
 
 def not_authorized():
-    status_line = HTTP_VERSION + ' 401 Unauthorized'
-    content_length = 'Content-Length: 0'
-    return '{}\r\n{}\r\n\r\n'.format(status_line, content_length)
+    return NOT_AUTHORIZED_RESPONSE
 
 
 def bad_request():
-    return HTTP_VERSION + ' 400 Bad Request\r\nContent-Length: 0\r\n\r\n'
+    return BAD_REQUEST_RESPONSE
 
 
 def not_found():
-    return HTTP_VERSION + ' 404 Not Found\r\nContent-Length: 0\r\n\r\n'
+    return NOT_FOUND_RESPONSE
 
 
 def not_allowed():
-    return HTTP_VERSION + ' 405 Method Not Allowed\r\nContent-Length: 0\r\n\r\n'
+    return NOT_ALLOWED_RESPONSE
 
 
 def not_supported():
-    return HTTP_VERSION + ' 505 HTTP Version Not Supported\r\nContent-Length: 0\r\n\r\n'
+    return NOT_SUPPORTED_RESPONSE
 
 
 def server_error():
-    return HTTP_VERSION + ' 500 Internal Server Error\r\nContent-Length: 0\r\n\r\n'
+    return SERVER_ERROR_RESPONSE
 
 
-def response_header_template(status_code, response_body):
-    # response header contents
-    status_line = '{} {}'.format(HTTP_VERSION, status_code)
-    content_length = 'Content-Length: {}'.format(len(response_body))
-    content_type = 'Content-Type: application/json'
-    more_access = 'Access-Control-Allow-Origin: *'
-    access_control = 'Access-Control-Allow-Origin: localhost:8265/'
+# for the errors that don't have a helper of their own, like the parser's
+def error_response(status):
+    return empty_response(status)
+
+
+def service_unavailable():
+    return SERVICE_UNAVAILABLE_RESPONSE
+
+
+NOT_AUTHORIZED_RESPONSE = empty_response('401 Unauthorized')
+BAD_REQUEST_RESPONSE = empty_response('400 Bad Request')
+NOT_FOUND_RESPONSE = empty_response('404 Not Found')
+NOT_ALLOWED_RESPONSE = empty_response('405 Method Not Allowed')
+NOT_SUPPORTED_RESPONSE = empty_response('505 HTTP Version Not Supported')
+SERVER_ERROR_RESPONSE = empty_response('500 Internal Server Error')
+SERVICE_UNAVAILABLE_RESPONSE = [status_line('503 Service Unavailable') + header_line('Retry-After', RETRY_AFTER) +
+                                NO_CONTENT_HEADERS + CONNECTION_CLOSE_HEADER, b'']
+# for a long-poll or event stream we don't have room for. the connection itself can carry on
+CHANGE_FEED_BUSY_RESPONSE = [status_line('503 Service Unavailable') + header_line('Retry-After', RETRY_AFTER) +
+                             NO_CONTENT_HEADERS, b'']
+
+
+# checks whether gzip is one of the codings in the client's Accept-Encoding
+# (and that they didn't turn it down with q=0). gzip named on its own counts over a * wildcard
+def accepts_gzip(remaining_request):
+    wildcard_quality = None
+    for coding in remaining_request.get('Accept-Encoding', '').split(','):
+        name, _, parameters = coding.partition(';')
+        name = name.strip().lower()
+        if name in ('gzip', 'x-gzip', '*'):
+            quality = 1.0
+            parameter_name, _, value = parameters.partition('=')
+            if parameter_name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+            if name != '*':
+                return quality > 0
+            wildcard_quality = quality
+
+    return wildcard_quality is not None and wildcard_quality > 0
+
+
+def should_compress(body_length):
+    return GZIP_LEVEL > 0 and body_length >= GZIP_MIN_SIZE
+
+
+def is_compressible(content_type):
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+# mtime=0 keeps the output the same every time for the same input
+def compress(response_body):
+    started = time.perf_counter()
+    compressed = gzip.compress(response_body, compresslevel=GZIP_LEVEL, mtime=0)
+    metrics.add_stage_time('compress', time.perf_counter() - started)
+    return compressed
+
+
+# "abc" -> "abc-gzip"
+def gzip_etag(etag):
+    return '{}-gzip"'.format(etag[:-1])
+
 
-    return '{}\r\n{}\r\n{}\r\n{}\r\n{}'.format(status_line, content_length, content_type, more_access, access_control)
+# the headers that let clients ask "has this changed?" next time instead of downloading it again
+def validator_headers(etag, last_modified, cache_control):
+    etag_header = header_line('ETag', etag)
+    last_modified_header = header_line('Last-Modified', formatdate(last_modified, usegmt=True))
+    cache_control_header = header_line('Cache-Control', cache_control)
+    return etag_header + last_modified_header + cache_control_header
 
 
-def cookie_header(connection, header_template):
+# a 304 has no body, so it doesn't get a Content-Length either
+def not_modified_template(validators):
+    return status_line('304 Not Modified') + validators
+
+
+# If-None-Match can list several ETags, or "*" for anything
+def etag_matches(if_none_match, etag):
+    if if_none_match.strip() == '*':
+        return True
+
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        # If-None-Match uses the weak comparison, so W/"x" matches "x"
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+
+    return False
+
+
+# checks the conditional headers from the request against what we'd send.
+# If-Modified-Since only counts when there's no If-None-Match
+def is_not_modified(remaining_request, etag, last_modified):
+    not_modified = False
+
+    if 'If-None-Match' in remaining_request:
+        not_modified = etag_matches(remaining_request['If-None-Match'], etag)
+
+    elif 'If-Modified-Since' in remaining_request:
+        try:
+            since = parsedate_to_datetime(remaining_request['If-Modified-Since']).timestamp()
+            # Last-Modified only has whole seconds
+            not_modified = int(last_modified) <= since
+        except (TypeError, ValueError):
+            not_modified = False
+
+    return not_modified
+
+
+# param response_body: bytes, so Content-Length counts bytes and not characters
+def response_header_template(status_code, response_body):
+    return status_line(status_code) + b'Content-Length: %d\r\n' % len(response_body) + JSON_HEADERS
+
+
+# hands the client a session id. with signing keys the cookie holds a signed token for the id
+# and nothing is stored yet: the session gets its row with the first write it makes, so visitors
+# who only read never cost an insert. without them the bare id is only as good as its row,
+# so the row is written now, or its last_seen moved up for a session we already have
+# param session_id: the session to hand out a fresh cookie for, or None for a new session
+# return: the header template with the cookie added, or None if the session couldn't be stored
+def cookie_header(connection, header_template, session_id=None):
+    started = time.perf_counter()
     response_header = None
 
-    session_id = str(uuid.uuid4())
+    if session_id is None:
+        session_id = str(uuid.uuid4())
+
+    if sessiontokens.enabled():
+        cookie_value = sessiontokens.sign(session_id)
+
     # add the session id to the database
-    add_session = memodb.add_session(connection, session_id)
+    elif memodb.add_session(connection, session_id) is not None:
+        SESSION_CACHE.put(session_id, int(time.time()))
+        cookie_value = session_id
 
-    # if the ID was added to the database, we'll send it to the client
-    if add_session is not None:
-        set_cookie = 'Set-Cookie: session_id={}'.format(session_id)
-        response_header = '{}\r\n{}'.format(header_template, set_cookie)
+    # if we couldn't add the ID for whatever reason, there's no cookie to send
+    else:
+        cookie_value = None
 
+    if cookie_value is not None:
+        response_header = header_template + header_line('Set-Cookie', 'session_id={}'.format(cookie_value))
+
+    metrics.add_stage_time('session', time.perf_counter() - started)
     return response_header
 
 
+# return: when the session was last seen, 0 if there's no such session, or None if the query failed
+def session_last_seen(connection, session_id):
+    # if we've seen this one recently we don't need to ask the database again
+    last_seen = SESSION_CACHE.get(session_id)
+
+    if last_seen is None:
+        rows = memodb.get_session_by_id(connection, session_id)
+        if rows is None:
+            return None
+
+        last_seen = 0
+        if rows:
+            last_seen = rows[0][0]
+            SESSION_CACHE.put(session_id, last_seen)
+
+    return last_seen
+
+
+# returns [1, session id, True if its cookie should be replaced] for the first cookie holding
+# a session id, or [0, '', False] if none do, or None if the database couldn't be checked.
+# with signing keys only a token we signed counts, and it's checked without a lookup. session ids
+# are shown to everyone as last_edited_by, so without them anyone could send someone else's id
+# as their own. without keys the id has to have a row that was seen within the session lifetime,
+# so the cookie of a session that expired, or was pruned, stops working
 def find_session_id(connection, all_cookies):
+    started = time.perf_counter()
     found = None
     failed_query = 0
     cookies = all_cookies.split("; ")
@@ -91,56 +411,290 @@ def find_session_id(connection, all_cookies):
             split_cookie = cookie.split("=")
             cookie_value = split_cookie[1]  # this holds the actual session id value
 
-            # check if the Cookie is in our database
-            check_id = memodb.get_session_by_id(connection, cookie_value)
-            # make sure an error wasn't thrown
+            if sessiontokens.enabled():
+                verified = sessiontokens.verify(cookie_value)
+                if verified is not None:
+                    found = [1, verified[0], verified[1]]
+                    keep_searching = 0
 
-            if check_id is not None:
+            else:
+                last_seen = session_last_seen(connection, cookie_value)
 
-                # if the list that's returned isn't empty, the ID is in the database
-                # and we can stop the loop. if not, keep searching
-                if check_id:
-                    found = [1, cookie_value]
+                # if last_seen is None, something went wrong querying the database
+                if last_seen is None:
                     keep_searching = 0
+                    failed_query = 1
 
-            # if check_id is None, something went wrong querying the database
-            else:
-                keep_searching = 0
-                failed_query = 1
+                # a session that's still live, and we can stop the loop. if not, keep searching
+                elif time.time() - last_seen < SESSION_LIFETIME:
+                    found = [1, cookie_value, time.time() - last_seen > SESSION_REFRESH_AGE]
+                    keep_searching = 0
 
     if found is None and failed_query == 0:
-        found = [0, '']
+        found = [0, '', False]
 
+    metrics.add_stage_time('session', time.perf_counter() - started)
     return found
 
 
-def get_api(connection, path, remaining_request):
+# returns [version, the whole memo table as encoded JSON, ETag, Last-Modified time,
+# gzipped JSON or None], or None if the query failed. the encoded list is kept and handed out again
+# until a memo is added, changed or deleted
+def get_memo_list(connection):
+    global memo_list_cache
+
+    # read the version before the query. if a write sneaks in between, we cache
+    # newer rows under an older version and just rebuild once more next time
+    version, modified_time = memodb.memo_table_version_and_time()
+    cached = memo_list_cache
+    # with shared versions the list is read along with its exact revision, which can be a little
+    # ahead of this worker's change log. it's still the newest we know of
+    if cached[0] == version or (memodb.shared_versions and cached[0] is not None and cached[0] > version):
+        with memo_list_stats_lock:
+            memo_list_stats['hits'] += 1
+        return cached
+
+    if memodb.shared_versions:
+        memo_table = memodb.get_all_memos_and_revision(connection)
+        if memo_table is None:
+            return None
+        version, memo_rows = memo_table
+    else:
+        memo_rows = memodb.get_all_memos(connection)
+        if memo_rows is None:
+            return None
+
+    # an empty memo table gets an empty body
+    memo_list = b''
+    if memo_rows:
+        memo_list = memodb.to_dict_json(MEMO_KEYS, memo_rows, MEMO_JSON_INDENT).encode(FORMAT)
+
+    # the compressed copy is made once per version, not once per request
+    compressed = None
+    if should_compress(len(memo_list)):
+        compressed = compress(memo_list)
+
+    etag = '"memos-{}-{}"'.format(SERVER_INSTANCE, version)
+    cached = [version, memo_list, etag, modified_time, compressed]
+    memo_list_cache = cached
+    with memo_list_stats_lock:
+        memo_list_stats['rebuilds'] += 1
+    return cached
+
+
+def server_statistics():
+    statistics = {'session_cache': SESSION_CACHE.statistics()}
+    if FILE_CACHE is not None:
+        statistics['file_cache'] = FILE_CACHE.statistics()
+    with memo_list_stats_lock:
+        statistics['memo_list'] = dict(memo_list_stats, version=memo_list_cache[0])
+    if CONNECTION_QUEUE is not None:
+        statistics['worker_pool'] = pool_statistics(CONNECTION_QUEUE)
+    if memodb.group_writer is not None:
+        statistics['group_commit'] = memodb.group_writer.statistics()
+    return statistics
+
+
+# the client asked for one page of memos rather than the whole list
+def wants_memo_page(query):
+    return 'limit' in query or 'after' in query or 'last_edited_by' in query
+
+
+# reads ?limit=&after=&last_edited_by= into [after, limit, last_edited_by].
+# returns None if limit or after aren't sensible numbers
+def parse_page_query(query):
+    page = None
+
+    limit = query.get('limit', str(PAGE_SIZE))
+    after = query.get('after', '0')
+    if limit.isdecimal() and after.isdecimal() and int(limit) > 0:
+        page = [int(after), min(int(limit), MAX_PAGE_SIZE), query.get('last_edited_by')]
+
+    return page
+
+
+# returns [header template, encoded body] for a 200 holding body_dict as JSON,
+# gzipped if it's big enough and the client takes gzip
+def json_page_response(body_dict, remaining_request):
+    response_body = memodb.to_json(body_dict, MEMO_JSON_INDENT).encode(FORMAT)
+
+    encoding_headers = VARY_HEADER
+    if accepts_gzip(remaining_request) and should_compress(len(response_body)):
+        response_body = compress(response_body)
+        encoding_headers = GZIP_HEADER + encoding_headers
+
+    header_template = response_header_template(HTTP_SUCCESS, response_body) + API_CACHE_HEADER + encoding_headers
+    return [header_template, response_body]
+
+
+# returns [header template, encoded body] for one page of memos, or None if the query failed.
+# next is the cursor for the page after this one, or null on the last page
+def memo_page_response(connection, page, remaining_request):
+    after, limit, last_edited_by = page
+
+    # ask for one extra row so we know whether there's another page after this one
+    memo_rows = memodb.get_memos_page(connection, after, limit + 1, last_edited_by)
+    if memo_rows is None:
+        return None
+
+    next_cursor = None
+    if len(memo_rows) > limit:
+        memo_rows = memo_rows[:limit]
+        next_cursor = memo_rows[-1][0]
+
+    page_body = {'memos': memodb.rows_to_dicts(MEMO_KEYS, memo_rows), 'next': next_cursor}
+    return json_page_response(page_body, remaining_request)
+
+
+# reads ?since_rev=&limit= into [since revision, limit]. limit defaults to the most we allow.
+# returns None if either isn't a sensible number
+def parse_sync_query(query):
+    sync = None
+
+    since_revision = query.get('since_rev', '')
+    limit = query.get('limit', str(MAX_PAGE_SIZE))
+    if since_revision.isdecimal() and limit.isdecimal() and int(limit) > 0:
+        sync = [int(since_revision), min(int(limit), MAX_PAGE_SIZE)]
+
+    return sync
+
+
+# returns [header template, encoded body] with the memos changed and deleted after
+# since_rev, or None if the query failed. the body looks like
+#   {"revision": 120, "more": false, "changed": [...], "deleted": [4, 7]}
+# and the client syncs again later with since_rev set to revision. if there were more
+# than limit changes, more is true and revision is where this batch stopped
+def memo_sync_response(connection, sync, remaining_request):
+    since_revision, limit = sync
+
+    # one extra of each so we can tell whether there are more than limit changes in all
+    changes = memodb.get_memo_changes(connection, since_revision, limit + 1)
+    if changes is None:
+        return None
+
+    revision, memo_rows, tombstone_rows = changes
+
+    # both lists are in revision order, and no two changes share a revision,
+    # so the first limit revisions across the two are the ones to send
+    revisions = sorted([row[3] for row in memo_rows] + [row[1] for row in tombstone_rows])
+    more = len(revisions) > limit
+    if more:
+        revision = revisions[limit - 1]
+        memo_rows = [row for row in memo_rows if row[3] <= revision]
+        tombstone_rows = [row for row in tombstone_rows if row[1] <= revision]
+
+    sync_body = {'revision': revision, 'more': more, 'changed': memodb.rows_to_dicts(SYNC_KEYS, memo_rows),
+                 'deleted': [row[0] for row in tombstone_rows]}
+    return json_page_response(sync_body, remaining_request)
+
+
+# reads ?q=&limit=&offset= into [FTS5 query, offset, limit].
+# returns None if there's nothing to search for or limit or offset aren't sensible numbers
+def parse_search_query(query):
+    search = None
+
+    expression = memodb.search_expression(query.get('q', ''))
+    limit = query.get('limit', str(PAGE_SIZE))
+    offset = query.get('offset', '0')
+    if expression is not None and limit.isdecimal() and offset.isdecimal() and int(limit) > 0:
+        search = [expression, int(offset), min(int(limit), MAX_PAGE_SIZE)]
+
+    return search
+
+
+# returns [header template, encoded body] for one page of search results, best match
+# first, or None if the query failed. next is the offset of the following page
+def memo_search_response(connection, search, remaining_request):
+    expression, offset, limit = search
+
+    # ask for one extra row so we know whether there's another page after this one
+    result_rows = memodb.search_memos(connection, expression, offset, limit + 1)
+    if result_rows is None:
+        return None
+
+    next_offset = None
+    if len(result_rows) > limit:
+        result_rows = result_rows[:limit]
+        next_offset = offset + limit
+
+    page_body = {'memos': memodb.rows_to_dicts(SEARCH_RESULT_KEYS, result_rows), 'next': next_offset}
+    return json_page_response(page_body, remaining_request)
+
+
+# returns [header template, encoded body] for the whole memo list, or None if the query failed
+def memo_list_response(connection, remaining_request):
+    # get all the memos, already encoded. if the memo table is empty, so is our response_body
+    memo_list = get_memo_list(connection)
+
+    # make sure there wasn't an error completing this query
+    if memo_list is None:
+        return None
+
+    # send the gzipped copy if there is one and the client can take it.
+    # the two copies are different bytes, so they need different ETags
+    use_gzip = memo_list[4] is not None and accepts_gzip(remaining_request)
+    if use_gzip:
+        response_body = memo_list[4]
+        etag = gzip_etag(memo_list[2])
+    else:
+        response_body = memo_list[1]
+        etag = memo_list[2]
+
+    # clients pass the version on to GET /api/memos/changes?since= to hear about what changes next
+    validators = validator_headers(etag, memo_list[3], API_CACHE_CONTROL) + VARY_HEADER + \
+        header_line('Memo-Version', memo_list[0])
+
+    # the client already has this version of the list, so we skip the body
+    if is_not_modified(remaining_request, etag, memo_list[3]):
+        response_body = b''
+        header_template = not_modified_template(validators)
+
+    # now that we have our response body, deal with the response header
+    else:
+        header_template = response_header_template(HTTP_SUCCESS, response_body) + validators
+        if use_gzip:
+            header_template += GZIP_HEADER
+
+    return [header_template, response_body]
+
+
+def get_api(connection, path, remaining_request, query):
     # default values
     response = bad_request()  # if the path list has more than 1 value, this is a bad request
-    response_body = ''
 
     # otherwise
-    if len(path) == 1:
+    is_search = len(path) == 2 and path[0] == 'memos' and path[1] == 'search'
+    if len(path) == 1 or is_search:
         # we only deal with memos in this API
         if path[0] == 'memos':
 
-            # get all the memos from the database
-            memo_rows = memodb.get_all_memos(connection)
-
-            # make sure there wasn't an error completing this query
-            if memo_rows is not None:
-
-                # check if the memo table is empty or not
-                if memo_rows:
-                    memo_keys = ['memo_id', 'content', 'last_edited_by']
-                    response_body = memodb.to_dict_json(memo_keys, memo_rows)
+            memo_response = None
+            bad_query = False
+            if is_search:
+                search = parse_search_query(query)
+                bad_query = search is None
+                if search is not None:
+                    memo_response = memo_search_response(connection, search, remaining_request)
+            elif 'since_rev' in query:
+                sync = parse_sync_query(query)
+                bad_query = sync is None
+                if sync is not None:
+                    memo_response = memo_sync_response(connection, sync, remaining_request)
+            elif wants_memo_page(query):
+                page = parse_page_query(query)
+                bad_query = page is None
+                if page is not None:
+                    memo_response = memo_page_response(connection, page, remaining_request)
+            else:
+                memo_response = memo_list_response(connection, remaining_request)
 
-                # if the memo table is empty, so is our response_body.
-                # this is the default value for response_body so we
-                # don't have to do anything
+            # a search with no words, or a bad limit, cursor or revision, is the client's fault
+            if bad_query:
+                response = bad_request()
 
-                # now that we have our response body, deal with the response header
-                header_template = response_header_template(HTTP_SUCCESS, response_body)
+            # make sure there wasn't an error completing the query
+            elif memo_response is not None:
+                header_template, response_body = memo_response
 
                 # if the request header doesn't have a tracking Cookie
                 if 'Cookie' not in remaining_request:
@@ -148,7 +702,7 @@ def get_api(connection, path, remaining_request):
                     response_header = cookie_header(connection, header_template)
 
                     if response_header is not None:
-                        response = '{}\r\n\r\n{}'.format(response_header, response_body)
+                        response = [response_header, response_body]
 
                     # if we couldn't add the ID for whatever reason, our bad
                     else:
@@ -156,34 +710,39 @@ def get_api(connection, path, remaining_request):
 
                 # if the request header has a tracking Cookie
                 else:
-                    # get the Cookie from the request header and check if it's in our database
+                    # get the Cookie from the request header and check that it's a live session
                     found = find_session_id(connection, remaining_request['Cookie'])
 
                     # if found is None there was a server error
                     if found is None:
                         response = server_error()
 
-                    # if not none, we can check if the id was in the database
+                    # if they have a session, don't need to set a tracking cookie,
+                    # unless it's old or its token was signed with a key that's being rotated out
+                    elif found[0] and not found[2]:
+                        response = [header_template, response_body]
+
+                    # otherwise refresh their session, or set our own tracking cookie
+                    # if there's no session id in it
                     else:
+                        response_header = cookie_header(connection, header_template, found[1] or None)
 
-                        # if we found the id in the database, don't need to set a tracking cookie
-                        if found[0]:
-                            response = '{}\r\n\r\n{}'.format(header_template, response_body)
+                        if response_header is not None:
+                            response = [response_header, response_body]
 
-                        # if we didn't find the id in our database, set our own tracking cookie
+                        # if we couldn't add the ID for whatever reason, our bad
                         else:
-                            response_header = cookie_header(connection, header_template)
-
-                            if response_header is not None:
-                                response = '{}\r\n\r\n{}'.format(response_header, response_body)
-
-                            # if we couldn't add the ID for whatever reason, our bad
-                            else:
-                                response = server_error()
+                            response = server_error()
 
             else:
                 response = server_error()
 
+        # counters for the caches and the worker pool
+        elif path[0] == 'stats':
+            response_body = json.dumps(server_statistics(), indent=4).encode(FORMAT)
+            response_header = response_header_template(HTTP_SUCCESS, response_body)
+            response = [response_header, response_body]
+
         else:
             response = not_found()
 
@@ -193,8 +752,6 @@ def get_api(connection, path, remaining_request):
 def post_api(connection, path, remaining_request, body):
     # if the request header doesn't have a Cookie, they're not authorized to make a POST
     response = not_authorized()
-    print(path)
-    print(body)
     # otherwise
     if 'Cookie' in remaining_request:
         if len(path) == 1:
@@ -209,36 +766,116 @@ def post_api(connection, path, remaining_request, body):
                 if found is None:
                     response = server_error()
 
-                # if not none, we can check if the id was in the database
-                else:
-
-                    # if we found the id in the database, we can add the memo
-                    if found[0]:
-                        add_memo = memodb.add_memo(connection, content, found[1])
-                        if add_memo is not None:
-                            # blank response body. nothing really to say
-                            response_body = ''
-                            response_header = response_header_template(HTTP_CREATED, response_body)
-                            # now we can bring it all together to form the response
-                            response = '{}\r\n\r\n{}'.format(response_header, response_body)
-
-                        # if the memo couldn't be added for whatever reason, server error (our fault)
-                        else:
-                            response = server_error()
-
-                    # if we didn't find the id in our database, they're not authorized to post
+                # if they have a session id, we can add the memo
+                elif found[0]:
+                    add_memo = memodb.add_memo(connection, content, found[1])
+                    if add_memo is not None:
+                        # blank response body. nothing really to say
+                        response_body = b''
+                        response_header = response_header_template(HTTP_CREATED, response_body)
+                        # now we can bring it all together to form the response
+                        response = [response_header, response_body]
+
+                    # if the memo couldn't be added for whatever reason, server error (our fault)
                     else:
-                        response = not_authorized()
+                        response = server_error()
+
+                # without a session id, they're not authorized to post
+                else:
+                    response = not_authorized()
 
             else:
                 response = not_found()
 
+        # several creates, updates and deletes in one request
+        elif len(path) == 2 and path[0] == 'memos' and path[1] == 'batch':
+            response = post_batch_api(connection, remaining_request, body)
+
         else:
             response = bad_request()
 
     return response
 
 
+# checks one operation from a batch. returns [op, memo id, content] ready for
+# memodb.apply_memo_batch, or a string saying what's wrong with it
+def parse_batch_operation(operation):
+    if not isinstance(operation, dict):
+        return 'operation must be an object'
+
+    op = operation.get('op')
+    memo_id = operation.get('memo_id')
+    content = operation.get('content')
+
+    if op not in ('create', 'update', 'delete'):
+        return 'op must be create, update or delete'
+    if op != 'delete' and not isinstance(content, str):
+        return 'content must be a string'
+    if op != 'create' and (not isinstance(memo_id, int) or isinstance(memo_id, bool)):
+        return 'memo_id must be an integer'
+
+    return [op, memo_id, content]
+
+
+# POST /api/memos/batch takes a JSON array of operations like
+#   {"op": "create", "content": "..."}
+#   {"op": "update", "memo_id": 3, "content": "..."}
+#   {"op": "delete", "memo_id": 3}
+# and runs them all in one transaction. the response has a result for each
+# operation, in the same order, with the status it would have had on its own
+def post_batch_api(connection, remaining_request, body):
+    response = bad_request()
+
+    try:
+        operations = json.loads(body)
+    except ValueError:
+        operations = None
+
+    if isinstance(operations, list) and 0 < len(operations) <= MAX_BATCH_OPERATIONS:
+        found = find_session_id(connection, remaining_request['Cookie'])
+
+        # if found is None, there was a server error
+        if found is None:
+            response = server_error()
+
+        # without a session id, they're not authorized to post
+        elif not found[0]:
+            response = not_authorized()
+
+        else:
+            parsed = [parse_batch_operation(operation) for operation in operations]
+            valid = [operation for operation in parsed if isinstance(operation, list)]
+
+            batch_results = []
+            if valid:
+                batch_results = memodb.apply_memo_batch(connection, found[1], valid)
+
+            # the whole transaction was rolled back
+            if batch_results is None:
+                response = server_error()
+
+            else:
+                results = []
+                batch_results = iter(batch_results)
+                for operation in parsed:
+                    if isinstance(operation, str):
+                        results.append({'status': 400, 'error': operation})
+                    else:
+                        memo_id = next(batch_results)
+                        if memo_id is None:
+                            results.append({'status': 404, 'memo_id': operation[1]})
+                        elif operation[0] == 'create':
+                            results.append({'status': 201, 'memo_id': memo_id})
+                        else:
+                            results.append({'status': 200, 'memo_id': memo_id})
+
+                response_body = memodb.to_json({'results': results}, MEMO_JSON_INDENT).encode(FORMAT)
+                response_header = response_header_template(HTTP_SUCCESS, response_body)
+                response = [response_header, response_body]
+
+    return response
+
+
 def put_api(connection, path, remaining_request, body):
     # if the request header doesn't have a Cookie, they're not authorized to update
     response = not_authorized()
@@ -251,53 +888,51 @@ def put_api(connection, path, remaining_request, body):
 
                 memo_id = int(path[1])
 
-                # check if their cookie is in our database
+                # get their session id out of the cookie
                 found = find_session_id(connection, remaining_request['Cookie'])
 
                 # if found is None, there was a server error
                 if found is None:
                     response = server_error()
 
-                # if not none, we can check if the id was in the database
-                else:
-
-                    # if we found their id in the database, they're authorized to update
-                    if found[0]:
+                # if they have a session id, they're authorized to update
+                elif found[0]:
 
-                        # now we can check if the memo they want is in the database
-                        get_memo = memodb.get_memo_by_id(connection, memo_id)
+                    # now we can check if the memo they want is in the database
+                    get_memo = memodb.get_memo_by_id(connection, memo_id)
 
-                        # if the memo id is in our database this will be true.
-                        # (python returns true if non-empty list)
-                        if get_memo:
+                    # if the memo id is in our database this will be true.
+                    # (python returns true if non-empty list)
+                    if get_memo:
 
-                            # now we can start constructing our response.
+                        # now we can start constructing our response.
 
-                            # empty response body because we don't have anything to say
-                            response_body = ''
+                        # empty response body because we don't have anything to say
+                        response_body = b''
 
-                            # get the message from the request body
-                            body_dictionary = json.loads(body)
-                            body_key = next(iter(body_dictionary))  # get the key for the message
-                            content = body_dictionary[body_key]
+                        # get the message from the request body
+                        body_dictionary = json.loads(body)
+                        body_key = next(iter(body_dictionary))  # get the key for the message
+                        content = body_dictionary[body_key]
 
-                            update = memodb.update_memo_by_id(connection, memo_id, found[1], content)
+                        update = memodb.update_memo_by_id(connection, memo_id, found[1], content)
 
-                            # if the update was successful, tell the client
-                            if update == 1:
-                                response = response_header_template(HTTP_SUCCESS, response_body)
+                        # if the update was successful, tell the client
+                        if update == 1:
+                            response_header = response_header_template(HTTP_SUCCESS, response_body)
+                            response = [response_header, response_body]
 
-                            # otherwise, there was some issue with the database (our fault)
-                            else:
-                                response = server_error()
-
-                        # if the memo id isn't in our database, 404
+                        # otherwise, there was some issue with the database (our fault)
                         else:
-                            response = not_found()
+                            response = server_error()
 
-                    # if we didn't find their id in our database, they're not authorized to update
+                    # if the memo id isn't in our database, 404
                     else:
-                        response = not_authorized()
+                        response = not_found()
+
+                # without a session id, they're not authorized to update
+                else:
+                    response = not_authorized()
 
             # if the first value isn't "memo" we don't have it
             else:
@@ -322,47 +957,45 @@ def delete_api(connection, path, remaining_request):
 
                 memo_id = int(path[1])
 
-                # check if their cookie is in our database
+                # get their session id out of the cookie
                 found = find_session_id(connection, remaining_request['Cookie'])
 
                 # if found is None, there was a server error
                 if found is None:
                     response = server_error()
 
-                # if not none, we can check if the id was in the database
-                else:
-
-                    # if we found their id in the database, they're authorized to update
-                    if found[0]:
-
-                        # now we can check if the memo they want is in the database
-                        get_memo = memodb.get_memo_by_id(connection, memo_id)
+                # if they have a session id, they're authorized to update
+                elif found[0]:
 
-                        # if the memo id is in our database this will be true.
-                        # (python returns true if non-empty list)
-                        if get_memo:
+                    # now we can check if the memo they want is in the database
+                    get_memo = memodb.get_memo_by_id(connection, memo_id)
 
-                            # now we can start constructing our response.
+                    # if the memo id is in our database this will be true.
+                    # (python returns true if non-empty list)
+                    if get_memo:
 
-                            # empty response body because we don't have anything to say
-                            response_body = ''
+                        # now we can start constructing our response.
 
-                            delete_memo = memodb.delete_memo_by_id(connection, memo_id)
-                            # if the memo was deleted, send an OK message
-                            if delete_memo == 1:
-                                response = response_header_template(HTTP_SUCCESS, response_body)
+                        # empty response body because we don't have anything to say
+                        response_body = b''
 
-                            # if the memo deletion failed, server error
-                            else:
-                                response = server_error()
+                        delete_memo = memodb.delete_memo_by_id(connection, memo_id, found[1])
+                        # if the memo was deleted, send an OK message
+                        if delete_memo == 1:
+                            response_header = response_header_template(HTTP_SUCCESS, response_body)
+                            response = [response_header, response_body]
 
-                        # if the memo id isn't in our database, 404
+                        # if the memo deletion failed, server error
                         else:
-                            response = not_found()
+                            response = server_error()
 
-                    # if we didn't find their id in our database, they're not authorized to update
+                    # if the memo id isn't in our database, 404
                     else:
-                        response = not_authorized()
+                        response = not_found()
+
+                # without a session id, they're not authorized to update
+                else:
+                    response = not_authorized()
 
             # if the first value isn't "memo", we don't have it
             else:
@@ -375,12 +1008,12 @@ def delete_api(connection, path, remaining_request):
     return response
 
 
-def handle_api(database_conn, verb, path, remaining_request, body):
+def handle_api(database_conn, verb, path, remaining_request, body, query):
     # at this point we've made sure the verb is one of the 4
     # so if something goes wrong, it's on us
     response = server_error()
     if verb == "GET":
-        response = get_api(database_conn, path, remaining_request)
+        response = get_api(database_conn, path, remaining_request, query)
     elif verb == "POST":
         response = post_api(database_conn, path, remaining_request, body)
     elif verb == "PUT":
@@ -391,253 +1024,1247 @@ def handle_api(database_conn, verb, path, remaining_request, body):
     return response
 
 
-def file_header_template(cont_length, cont_type):
-    status_line = '{} {}'.format(HTTP_VERSION, HTTP_SUCCESS)
-    content_type = 'Content-Type: {}'.format(cont_type)
-    content_length = 'Content-Length: {}'.format(cont_length)
-    return '{}\r\n{}\r\n{}'.format(status_line, content_type, content_length)
+def file_header_template(cont_length, cont_type, status_code=HTTP_SUCCESS):
+    return status_line(status_code) + header_line('Content-Type', cont_type) + b'Content-Length: %d\r\n' % cont_length
 
 
-def get_file_info(root, folder_type, search_name):
-    result = None
+def is_file_response(response):
+    return len(response) == 4
 
-    path_name = ''
 
-    # default type is
-    content_type = 'text/plain; charset=us-ascii'
+# the buffers that make up the response, in the order they go on the wire. a file's
+# body isn't one of them, it's sent after these with sendfile
+def response_buffers(response):
+    if is_file_response(response):
+        return [response[0], CRLF]
+    return [response[0], CRLF, response[1]]
 
-    keep_reading = 1
 
-    # loop through all the files in the current file or directory and see if ours is there
-    for name in folder_type:
-        # keep reading until we find our file
-        if keep_reading:
+# tells the client whether we'll keep the connection open after this response.
+# only the header block is copied, the body is passed along as it is
+def add_connection_header(response, keep_alive, requests_left):
+    if keep_alive:
+        connection = keep_alive_headers.get(requests_left)
+        if connection is None:
+            connection = header_line('Connection', 'keep-alive') + \
+                header_line('Keep-Alive', 'timeout={}, max={}'.format(KEEP_ALIVE_TIMEOUT, requests_left))
+            keep_alive_headers[requests_left] = connection
+    else:
+        connection = CONNECTION_CLOSE_HEADER
 
-            path_name = os.path.join(root, name)
-            file_name = name  # the name we're going to compare search_name to
-            extension = os.path.splitext(name)[1]
+    return [response[0] + connection] + response[1:]
 
-            # if we find our file
-            if file_name == search_name:
 
-                keep_reading = 0
-                # if the file extension is some kind of image, content_type = image/something
-                if extension == '.jpeg' or extension == '.png' or extension == '.jpg' or extension == '.ico':
+# writes every buffer with as few sendmsg calls as it takes (one, unless the socket
+# buffer fills up), picking up partway through a buffer where the last call stopped
+def send_buffers(socket_conn, buffers):
+    buffers = [memoryview(buffer) for buffer in buffers if buffer]
 
-                    if extension == '.jpeg' or extension == '.jpg':
-                        content_type = 'image/jpeg'
+    while buffers:
+        sent = socket_conn.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if sent:
+            buffers[0] = buffers[0][sent:]
 
-                    elif extension == '.png':
-                        content_type = 'image/png'
 
-                    else:
-                        content_type = 'image/vnd.microsoft.icon'
+# file bodies go straight from the file to the socket with sendfile, without ever
+# being read into memory. returns False if the whole body couldn't be sent
+def send_response(socket_conn, response):
+    complete = True
 
-                # otherwise, the file is gonna be html or something else
-                else:
-                    if extension == '.html':
-                        content_type = 'text/html'
+    if is_file_response(response):
+        _, body_file, offset, count = response
+        try:
+            send_buffers(socket_conn, response_buffers(response))
+            # a count of 0 would mean "until the end of the file" to sendfile
+            if count:
+                complete = socket_conn.sendfile(body_file, offset, count) == count
+        finally:
+            body_file.close()
 
-    if not keep_reading:
-        result = [path_name, content_type]
+    else:
+        send_buffers(socket_conn, response_buffers(response))
 
-    return result
+    return complete
 
 
-# this returns the pathname of the file we're looking for as well as
-# the content type of that file
-# if the file wasn't found, response is null
-def file_search(search_name, working_directory):
-    response = None
+async def send_response_async(writer, response):
+    complete = True
 
-    keep_reading = 1
-    for root, directories, files in os.walk(working_directory):
-        if keep_reading:
-            response = get_file_info(root, files, search_name)
-            if response is not None:
-                keep_reading = 0
-            # if the correct file wasn't found, check the directories
-            else:
-                response = get_file_info(root, directories, search_name)
+    if is_file_response(response):
+        _, body_file, offset, count = response
+        try:
+            writer.writelines(response_buffers(response))
+            await writer.drain()
+            if count:
+                loop = asyncio.get_running_loop()
+                complete = await loop.sendfile(writer.transport, body_file, offset, count) == count
+        finally:
+            body_file.close()
 
-    return response
+    else:
+        writer.writelines(response_buffers(response))
+        await writer.drain()
 
+    return complete
 
-def respond_and_close(response, socket_conn, database_conn):
-    # print(response)
-    # send the response over the socket
-    socket_conn.sendall(response.encode(FORMAT))
-    # now we're done, we can close the database connection
-    database_conn.close()
-    # now we're done, close the current socket connection
-    socket_conn.close()
 
+# HTTP/1.1 connections stay open unless the client says otherwise,
+# older versions only stay open if the client asks for it
+def wants_keep_alive(request):
+    connection = request['headers'].get('Connection', '').lower()
+
+    if request['version'] == HTTP_VERSION:
+        keep_alive = connection != 'close'
+    else:
+        keep_alive = connection == 'keep-alive'
+
+    return keep_alive
+
+
+def create_parser():
+    return httpparser.RequestParser(MAX_HEADER_SIZE, MAX_BODY_SIZE)
+
+
+# reads from the socket until the parser has a whole request.
+# anything after it (the start of the next pipelined request) stays in the parser.
+# returns None if the client hung up first
+def read_request(socket_conn, parser):
+    # the clock starts once some of the request is here, not while we wait for it
+    started = time.perf_counter() if parser.buffer else None
+    request = parser.next_request()
+    while request is None:
+        # the client is waiting for our go-ahead before sending the body
+        if parser.continue_pending:
+            parser.continue_pending = False
+            socket_conn.sendall(CONTINUE_RESPONSE)
+
+        data = socket_conn.recv(RECV_SIZE)
+        if not data:
+            return None
+        if started is None:
+            started = time.perf_counter()
+        parser.feed(data)
+        request = parser.next_request()
+    return finish_reading(request, started)
+
+
+async def read_request_async(reader, writer, parser):
+    started = time.perf_counter() if parser.buffer else None
+    request = parser.next_request()
+    while request is None:
+        if parser.continue_pending:
+            parser.continue_pending = False
+            writer.write(CONTINUE_RESPONSE)
+
+        data = await asyncio.wait_for(reader.read(RECV_SIZE), KEEP_ALIVE_TIMEOUT)
+        if not data:
+            return None
+        if started is None:
+            started = time.perf_counter()
+        parser.feed(data)
+        request = parser.next_request()
+    return finish_reading(request, started)
+
+
+# remembers when the request started arriving, so its total time can be measured once it's answered.
+# the time spent in each stage is kept with the request and only reported when it's done
+def finish_reading(request, started):
+    request['started'] = started
+    request['stages'] = {'parse': time.perf_counter() - started}
+    return request
+
+
+# the route a request is counted under in the metrics
+def request_route(request):
+    path = request['path'].partition('?')[0].rstrip('/') or '/'
+
+    if path in METRIC_ROUTES:
+        route = path
+    elif path.startswith('/api/memos/'):
+        route = '/api/memos/{id}'
+    elif path.startswith('/api/'):
+        route = '/api/other'
+    else:
+        route = 'static'
+
+    return route
+
+
+# "HTTP/1.1 404 Not Found..." -> "404"
+def response_status(response):
+    return response[0][len(HTTP_VERSION) + 1:len(HTTP_VERSION) + 4].decode(FORMAT)
 
-# this will also take the socket connection and the database connection
-def handle_file(socket_conn, database_conn, method, path):
-    # the file will be the last element in the array
-    file_name = path[len(path) - 1]
-    # otherwise, see if we can find the file and such
-    if method == 'GET':
 
-        # get our current working directory
-        file_path = os.getcwd()
-        # search for the filename in the current working directory
-        # we get the pathname of the file and the content type
-        file_info = file_search(file_name, file_path)
-        if file_info is None:
-            respond_and_close(not_found(), socket_conn, database_conn)
+# bytes sent for the response, counting a file sent with sendfile
+def response_size(response):
+    if is_file_response(response):
+        return len(response[0]) + len(CRLF) + response[3]
+    return len(response[0]) + len(CRLF) + len(response[1])
 
+
+# the session id in the session_id cookie the request came with, or None.
+# a signed token is logged as just its id, so the log never holds anything that works as a cookie
+def request_session(request):
+    for cookie in request['headers'].get('Cookie', '').split('; '):
+        name, _, value = cookie.partition('=')
+        if name == 'session_id':
+            return value.partition(sessiontokens.SEPARATOR)[0]
+    return None
+
+
+# counts a request once it's been answered, and how long it and each stage of it took,
+# then queues its access record. an event stream has no end worth timing, so only its 200 is counted
+def record_request(request, response):
+    route = request_route(request)
+
+    if response is None:
+        status = '200'
+        size = duration = None
+    else:
+        status = response_status(response)
+        size = response_size(response)
+        duration = time.perf_counter() - request['started']
+        REQUEST_SECONDS.observe(duration, route)
+        metrics.REQUEST_STAGE_SECONDS.observe_by_label(request['stages'])
+    method = request['method'] if request['method'] in METRIC_METHODS else 'other'
+    REQUESTS.inc(method, route, status)
+
+    if serverlog.wants_access_record(status):
+        serverlog.access(request['method'], request['path'], status, size, duration, request_session(request))
+
+
+# a request too broken to parse has no method or path worth reporting
+def record_parse_error(status):
+    REQUESTS.inc('unknown', 'unparsed', status[:3])
+
+
+def metrics_response():
+    response_body = metrics.render_all().encode(FORMAT)
+    response_header = file_header_template(len(response_body), METRICS_CONTENT_TYPE) + NO_STORE_HEADER
+    return [response_header, response_body]
+
+
+def range_not_satisfiable(file_size):
+    content_range = header_line('Content-Range', 'bytes */{}'.format(file_size))
+    return [status_line('416 Range Not Satisfiable') + content_range + NO_CONTENT_HEADERS, b'']
+
+
+# reads a "Range: bytes=first-last" header into [first byte, last byte].
+# returns None if there's no range we can use, so the whole file gets sent
+# (that includes asking for several ranges at once), or [] if the range is past the end of the file
+def parse_range(range_header, file_size):
+    unit, _, byte_range = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in byte_range:
+        return None
+
+    first, dash, last = byte_range.strip().partition('-')
+    if not dash:
+        return None
+
+    # "bytes=-500" is the last 500 bytes
+    if not first:
+        if not last.isdecimal():
+            return None
+        suffix_length = int(last)
+        if suffix_length == 0 or file_size == 0:
+            return []
+        return [max(0, file_size - suffix_length), file_size - 1]
+
+    if not first.isdecimal() or (last and not last.isdecimal()):
+        return None
+
+    start = int(first)
+    end = file_size - 1
+    if last:
+        end = min(int(last), file_size - 1)
+        if int(last) < start:
+            return None
+
+    if start >= file_size:
+        return []
+
+    return [start, end]
+
+
+# If-Range says "only send me part of it if it's still the version I have".
+# it holds either an ETag or a date
+def if_range_matches(remaining_request, etag, last_modified):
+    matches = True
+
+    if 'If-Range' in remaining_request:
+        if_range = remaining_request['If-Range'].strip()
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            # this needs the strong comparison, so weak ETags never match
+            matches = if_range == etag
         else:
+            try:
+                matches = int(parsedate_to_datetime(if_range).timestamp()) == int(last_modified)
+            except (TypeError, ValueError):
+                matches = False
+
+    return matches
+
+
+# whole responses for small files are built once and kept in FILE_CACHE, so serving
+# them again takes no filesystem calls at all. the gzipped copy is cached separately.
+# an entry is only good while the file's modification time and size still match the index
+def cached_file_response(file_info, validators, use_gzip):
+    cache_key = (file_info[0], use_gzip)
+    cached = FILE_CACHE.get(cache_key)
+    if cached is not None and cached[0] == file_info[3] and cached[1] == file_info[2]:
+        return cached[2]
+
+    try:
+        with open(file_info[0], 'rb') as f:
+            response_body = f.read()
+    except OSError:
+        return not_found()
+
+    if use_gzip:
+        response_body = compress(response_body)
+        validators = GZIP_HEADER + validators
+
+    response_header = file_header_template(len(response_body), file_info[1]) + ACCEPT_RANGES_HEADER + validators
+    response = [response_header, response_body]
+    FILE_CACHE.put(cache_key, [file_info[3], file_info[2], response], len(response_header) + len(response_body))
+    return response
+
+
+# finds the requested file and builds the whole response for it
+def handle_file(method, path, remaining_request):
+    response = not_found()
+    # otherwise, see if we can find the file and such
+    if method == 'GET':
+
+        # look the path up in the index of the document root.
+        # we get the pathname of the file, the content type, its size and modification time
+        file_info = staticfiles.lookup_file(path)
+        if file_info is not None:
             content_type = file_info[1]
-            if file_info[1] == 'image/jpeg' or file_info[1] == 'image/png' or file_info == 'image/vnd.microsoft.icon':
-                content_length = os.stat(file_info[0]).st_size
-                response_header = file_header_template(content_length, content_type)
-                f = open(file_info[0], "rb")
-                send_response_header = '{}\r\n\r\n'.format(response_header)
-                # send the header and the binary body separately
-                socket_conn.sendall(send_response_header.encode(FORMAT))
-                # send the binary directly
-                socket_conn.sendall(f.read())
-                # now we're done, we can close the database connection
-                database_conn.close()
-                # now we're done, close the current socket connection
-                socket_conn.close()
-                f.close()
+            # the file's modification time and size change whenever its contents do
+            etag = '"{:x}-{:x}"'.format(int(file_info[3] * 1000000), file_info[2])
+
+            # only text small enough to sit in the file cache gets a compressed copy,
+            # so we never compress the same file twice
+            cacheable = FILE_CACHE is not None and file_info[2] <= MAX_CACHED_FILE_SIZE
+            compressible = cacheable and is_compressible(content_type) and should_compress(file_info[2])
+            use_gzip = compressible and 'Range' not in remaining_request and accepts_gzip(remaining_request)
+            if use_gzip:
+                etag = gzip_etag(etag)
+
+            validators = validator_headers(etag, file_info[3], STATIC_CACHE_CONTROL)
+            if compressible:
+                validators += VARY_HEADER
+
+            # the client's copy is still good
+            if is_not_modified(remaining_request, etag, file_info[3]):
+                response = [not_modified_template(validators), b'']
+
             else:
-                f = open(file_info[0])
-                line = f.readline()
-                response_body = line
-                while line:
-                    response_body += '{}\r\n'.format(line.rstrip())
-                    line = f.readline()
-                response_header = file_header_template(len(response_body), content_type)
-                response = '{}\r\n\r\n{}'.format(response_header, response_body)
-                respond_and_close(response, socket_conn, database_conn)
-                f.close()
+                byte_range = None
+                if 'Range' in remaining_request and if_range_matches(remaining_request, etag, file_info[3]):
+                    byte_range = parse_range(remaining_request['Range'], file_info[2])
+
+                if byte_range == []:
+                    response = range_not_satisfiable(file_info[2])
+
+                # small files come straight out of memory, already built
+                elif byte_range is None and cacheable:
+                    response = cached_file_response(file_info, validators, use_gzip)
+
+                else:
+                    # the file is opened here so a missing file is still a 404. whoever sends
+                    # the response sends the body straight from the file and closes it
+                    try:
+                        body_file = open(file_info[0], 'rb')
+                    except OSError:
+                        body_file = None
+
+                    if body_file is not None:
+                        if byte_range is None:
+                            offset = 0
+                            count = file_info[2]
+                            response_header = file_header_template(count, content_type)
+
+                        # only the part they asked for
+                        else:
+                            offset = byte_range[0]
+                            count = byte_range[1] - byte_range[0] + 1
+                            response_header = file_header_template(count, content_type, HTTP_PARTIAL_CONTENT)
+                            response_header += header_line('Content-Range', 'bytes {}-{}/{}'.format(
+                                byte_range[0], byte_range[1], file_info[2]))
+
+                        response_header += ACCEPT_RANGES_HEADER + validators
+                        response = [response_header, body_file, offset, count]
 
     else:
         # if the type of method isn't GET, it's not allowed
-        respond_and_close(not_allowed(), socket_conn, database_conn)
+        response = not_allowed()
+
+    return response
 
 
 def initialize_db(connection):
     # create the table of sessionIDs if it doesn't exist
     sessions_statement = memodb.create_sessions_statement()
     memodb.create_table(connection, sessions_statement)
+    # sessions keep when they were created and last seen, and expired ones get pruned in last_seen order
+    memodb.start_session_timestamps(connection)
+    memodb.create_table(connection, memodb.create_session_index_statement())
 
     # create the table of memos if it doesn't exist
     memos_statement = memodb.create_memo_statement()
     memodb.create_table(connection, memos_statement)
 
+    # every change to a memo gets a revision, and deleted memos leave a tombstone,
+    # so clients can ask for just what changed since their last sync
+    memodb.create_table(connection, memodb.create_revision_statement())
+    memodb.create_table(connection, memodb.create_tombstone_statement())
+    memodb.start_memo_revisions(connection)
+    for revision_statement in memodb.create_revision_index_statements() + memodb.create_revision_trigger_statements():
+        memodb.create_table(connection, revision_statement)
+
+    # index for listing one person's memos a page at a time
+    index_statement = memodb.create_memo_index_statement()
+    memodb.create_table(connection, index_statement)
+
+    # full-text index for searching memos, kept up to date by triggers.
+    # if it's new, the memos from before it existed get indexed once here
+    search_index_exists = memodb.table_exists(connection, 'memos_search')
+    memodb.create_table(connection, memodb.create_memo_search_statement())
+    for trigger_statement in memodb.create_memo_search_trigger_statements():
+        memodb.create_table(connection, trigger_statement)
+    if not search_index_exists:
+        memodb.rebuild_search_index(connection)
+
+
+# works out the response for a parsed request. this doesn't touch the socket,
+# so both the threaded and the asyncio servers can use it
+def respond_to_request(database_conn, request):
+    try:
+        method = request['method']
+        path = request['path']
+        version = request['version']
+        remaining_request = request['headers']
+        body = request['body'].decode(FORMAT)
+
+        # make sure they're using version 1.1
+        version_number = version.split("/")[1]
+        if version_number != '1.1':
+            response = not_supported()
+
+        # check if they have the right method
+        elif method != "GET" and method != "POST" and method != "PUT" and method != "DELETE":
+            response = bad_request()
+
+        # make sure this is actually a path
+        elif path[0] == "/":
+            # pull the ?query string off the end of the path
+            path, _, query_string = path.partition("?")
+            query = dict(parse_qsl(query_string))
+            path_tokens = path[1:].split("/")
+            # print(path_tokens)
+            if path_tokens[0] == "api":
+                response = handle_api(database_conn, method, path_tokens[1:], remaining_request, body, query)
+
+            # if it's not an api request, open the files
+            else:
+                response = handle_file(method, path, remaining_request)
+
+        else:
+            response = bad_request()
+
+    except Exception:
+        response = server_error()
+
+    return response
+
+
+# GET /api/memos/changes needs no database, and may wait a long time, so it's
+# answered before we borrow a database connection
+def is_change_feed(request):
+    path = request['path'].partition('?')[0].rstrip('/')
+    return request['method'] == 'GET' and path == '/api/memos/changes'
+
+
+# reads the version to send changes after from ?since=, or from Last-Event-ID when an
+# EventSource reconnects. without either, the client only hears about changes from now on.
+# returns [since, whether the client wants an event stream], or None if since isn't a number
+def parse_change_feed(request):
+    query = dict(parse_qsl(request['path'].partition('?')[2]))
+    since = request['headers'].get('Last-Event-Id', query.get('since'))
+    wants_stream = 'text/event-stream' in request['headers'].get('Accept', '')
+
+    if since is None:
+        return [memodb.memo_table_version(), wants_stream]
+    if not since.isdecimal():
+        return None
+    return [int(since), wants_stream]
+
+
+# returns [current version, changes after since] as soon as there are any, or with no
+# changes once timeout seconds are up. the changes are None if the client has to start over
+def wait_for_changes(since, timeout):
+    changes = memodb.changes_since(since)
+    if changes[1] == []:
+        arrived = threading.Event()
+        memodb.add_change_listener(arrived.set)
+        try:
+            # something may have come in before the listener was added
+            changes = memodb.changes_since(since)
+            if changes[1] == [] and arrived.wait(timeout):
+                changes = memodb.changes_since(since)
+        finally:
+            memodb.remove_change_listener(arrived.set)
+
+    return changes
+
+
+# same as wait_for_changes, but waits on the event loop instead of tying up a thread
+async def wait_for_changes_async(since, timeout):
+    changes = memodb.changes_since(since)
+    if changes[1] == []:
+        loop = asyncio.get_running_loop()
+        arrived = asyncio.Event()
+
+        # the listener runs on whichever thread committed the change
+        def listener():
+            loop.call_soon_threadsafe(arrived.set)
+
+        memodb.add_change_listener(listener)
+        try:
+            changes = memodb.changes_since(since)
+            if changes[1] == []:
+                await asyncio.wait_for(arrived.wait(), timeout)
+                changes = memodb.changes_since(since)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            memodb.remove_change_listener(listener)
+
+    return changes
+
+
+# the long-poll answer: {"version": ..., "reset": false, "changes": [...]}. the client asks
+# again with since set to version. reset means we don't have every change it missed, so it
+# has to fetch the whole memo list again
+def change_feed_response(changes):
+    version, change_list = changes
+    feed_body = {'version': version, 'reset': change_list is None, 'changes': change_list or []}
+    response_body = memodb.to_json(feed_body, MEMO_JSON_INDENT).encode(FORMAT)
+
+    response_header = response_header_template(HTTP_SUCCESS, response_body) + NO_STORE_HEADER
+    return [response_header, response_body]
+
+
+# an event stream has no length, so it ends when the connection does
+def event_stream_header():
+    headers = b'Content-Type: text/event-stream\r\n' + NO_STORE_HEADER + b'Access-Control-Allow-Origin: *\r\n' + \
+        CONNECTION_CLOSE_HEADER
+    return status_line(HTTP_SUCCESS) + headers + CRLF + 'retry: {}\n\n'.format(EVENT_STREAM_RETRY).encode(FORMAT)
+
+
+# returns [the events to send for changes, the version to wait for changes after next].
+# every change is a "change" event with its version as the id, so a reconnecting
+# EventSource sends back the last one it saw. a "reset" event tells the client to
+# fetch the whole memo list again. nothing new gives a comment, which clients ignore
+def change_events(changes):
+    version, change_list = changes
+
+    if change_list is None:
+        events = 'event: reset\ndata: {}\n\n'.format(json.dumps({'version': version}))
+    elif change_list:
+        events = ''.join('id: {}\nevent: change\ndata: {}\n\n'.format(change['version'], json.dumps(change))
+                         for change in change_list)
+    else:
+        events = ': no changes\n\n'
+
+    return [events.encode(FORMAT), version]
+
+
+# sends changes down the connection as they happen, until the stream has been open for
+# EVENT_STREAM_DURATION seconds or the client goes away
+def stream_changes(socket_conn, since):
+    deadline = time.monotonic() + EVENT_STREAM_DURATION
+
+    try:
+        socket_conn.sendall(event_stream_header())
+        while time.monotonic() < deadline:
+            events, since = change_events(wait_for_changes(since, EVENT_STREAM_HEARTBEAT))
+            socket_conn.sendall(events)
+    except OSError:
+        pass
+
+
+async def stream_changes_async(writer, since):
+    deadline = time.monotonic() + EVENT_STREAM_DURATION
+
+    try:
+        writer.write(event_stream_header())
+        await writer.drain()
+        while time.monotonic() < deadline:
+            events, since = change_events(await wait_for_changes_async(since, EVENT_STREAM_HEARTBEAT))
+            writer.write(events)
+            await writer.drain()
+    except ConnectionError:
+        pass
+
+
+# answers GET /api/memos/changes with a long-poll response, or streams the changes to
+# clients that asked for text/event-stream and returns None once the stream is over
+def respond_to_change_feed(socket_conn, request):
+    feed = parse_change_feed(request)
+    if feed is None:
+        return bad_request()
+
+    if CHANGE_FEED_SLOTS is not None and not CHANGE_FEED_SLOTS.acquire(blocking=False):
+        with pool_stats_lock:
+            pool_stats['change_feeds_rejected'] += 1
+        return CHANGE_FEED_BUSY_RESPONSE
+
+    try:
+        since, wants_stream = feed
+        if wants_stream:
+            stream_changes(socket_conn, since)
+            return None
+
+        return change_feed_response(wait_for_changes(since, LONG_POLL_TIMEOUT))
+
+    finally:
+        if CHANGE_FEED_SLOTS is not None:
+            CHANGE_FEED_SLOTS.release()
+
+
+async def respond_to_change_feed_async(writer, request):
+    feed = parse_change_feed(request)
+    if feed is None:
+        return bad_request()
+
+    since, wants_stream = feed
+    if wants_stream:
+        await stream_changes_async(writer, since)
+        return None
+
+    return change_feed_response(await wait_for_changes_async(since, LONG_POLL_TIMEOUT))
 
-def handle_client(socket_conn, addr):
-    print(f"[NEW CONNECTION] {addr} connected.")
 
-    # start up the database connection
-    database_conn = memodb.create_connection("memoSystem.db")
+# borrows a database connection from the pool just long enough to answer one request.
+# the threaded servers call this directly and the asyncio server runs it on an executor thread.
+# the time spent on sessions, queries and encoding is added up while it runs
+def respond_with_database(request):
+    # the metrics don't need the database
+    if request['method'] == 'GET' and request['path'].partition('?')[0] == '/metrics':
+        return metrics_response()
 
+    metrics.start_stages(request['stages'])
+    database_conn = memodb.get_pooled_connection(DATABASE_POOL, DATABASE_POOL_TIMEOUT)
+
+    # every connection is busy, so we're overloaded
     if database_conn is None:
-        print("Error! Could not create the database connection.\n")
-        # # send the response over the socket
-        # socket_conn.sendall(server_error().encode(FORMAT))
-        # # now we're done, we can close the database connection
-        # # now we're done, close the current socket connection
-        socket_conn.close()
+        response = service_unavailable()
 
     else:
-        initialize_db(database_conn)
         try:
-            data = socket_conn.recv(1024).decode(FORMAT)
+            response = respond_to_request(database_conn, request)
+        finally:
+            memodb.return_pooled_connection(DATABASE_POOL, database_conn)
 
-            # split the request into header and body
-            split_header_body = data.partition("\r\n\r\n")  # [0] request, [1]: \r\n\r\n, [2]: body
+    metrics.stop_stages()
+    return response
 
-            # separate the request line from the rest of the request
-            split_request = split_header_body[0].split("\r\n", 1)
-            request_line = split_request[0]
-            remaining_request = request_to_dict(split_request[1])
-            # initialize the response body to blank
-            body = ''
 
-            # print(split_header_body[0])
+# True if the client has sent something we haven't read yet, or has hung up
+def has_data_waiting(socket_conn):
+    poller = select.poll()
+    poller.register(socket_conn, select.POLLIN)
+    return bool(poller.poll(0))
+
+
+# param state: [parser, requests served] for a connection coming back from the idle connection
+# watcher, or None for a new one
+# param park: in pool mode, so a connection with nothing to read goes back to the watcher
+# instead of holding this worker
+def handle_client(socket_conn, addr, state=None, park=False):
+    if state is None:
+        serverlog.debug('new connection', client=addr)
+        # a keep-alive connection that sits quiet for this long gets closed
+        socket_conn.settimeout(KEEP_ALIVE_TIMEOUT)
+        ACTIVE_CONNECTIONS.inc()
+        state = [create_parser(), 0]
+    parser, requests_served = state
+    keep_alive = True
+
+    # keep answering requests on this connection until one of us wants to close it.
+    # pipelined requests are already waiting in the buffer and get answered in order
+    while keep_alive:
+        if park and not parser.buffer and not has_data_waiting(socket_conn):
+            park_connection(socket_conn, addr, [parser, requests_served])
+            return
 
-            if 'Content-Length' in remaining_request and int(remaining_request['Content-Length']) > 0:
-                body = split_header_body[2]
+        try:
+            request = read_request(socket_conn, parser)
+        except (socket.timeout, ConnectionError):
+            request = None
+        # the request was malformed or too big, so we can't tell where the next one starts
+        except httpparser.ParseError as e:
+            request = None
+            record_parse_error(e.status)
+            try:
+                send_response(socket_conn, add_connection_header(error_response(e.status), False, 0))
+            except OSError:
+                pass
+
+        if request is None:
+            keep_alive = False
 
-            # split the GET from the path from the HTTP version
-            split_request_line = request_line.split(" ")
-            method = split_request_line[0].strip()
-            path = split_request_line[1].strip()
-            version = split_request_line[2].strip()
+        else:
+            requests_served += 1
+            try:
+                keep_alive = wants_keep_alive(request) and requests_served < MAX_KEEP_ALIVE_REQUESTS
+                if is_change_feed(request):
+                    response = respond_to_change_feed(socket_conn, request)
+                else:
+                    response = respond_with_database(request)
+            except Exception:
+                keep_alive = False
+                response = server_error()
 
-            # make sure they're using version 1.1
-            version_number = version.split("/")[1]
-            if version_number != '1.1':
-                respond_and_close(not_supported(), socket_conn, database_conn)
+            # an event stream was already sent, and it ends with the connection
+            if response is None:
+                keep_alive = False
 
             else:
+                try:
+                    requests_left = MAX_KEEP_ALIVE_REQUESTS - requests_served
+                    response = add_connection_header(response, keep_alive, requests_left)
+                    started = time.perf_counter()
+                    # if the file got shorter under us, the client can't tell where this response ends
+                    if not send_response(socket_conn, response):
+                        keep_alive = False
+                    request['stages']['send'] = time.perf_counter() - started
+                except OSError:
+                    keep_alive = False
+
+            record_request(request, response)
+
+    # now we're done, close the current socket connection
+    close_client(socket_conn)
+
+
+def close_client(socket_conn):
+    ACTIVE_CONNECTIONS.dec()
+    socket_conn.close()
 
-                # check if they have the right method
-                if method != "GET" and method != "POST" and method != "PUT" and method != "DELETE":
-                    respond_and_close(bad_request(), socket_conn, database_conn)
 
+# asyncio version of handle_client. waiting on the socket costs no thread here,
+# only the database and file work is handed to the executor
+async def handle_client_async(reader, writer):
+    serverlog.debug('new connection', client=writer.get_extra_info('peername'))
+    loop = asyncio.get_running_loop()
+    ACTIVE_CONNECTIONS.inc()
+    parser = create_parser()
+    requests_served = 0
+    keep_alive = True
+
+    try:
+        while keep_alive:
+            request = await read_request_async(reader, writer, parser)
+
+            if request is None:
+                keep_alive = False
+
+            else:
+                requests_served += 1
+                keep_alive = wants_keep_alive(request) and requests_served < MAX_KEEP_ALIVE_REQUESTS
+                if is_change_feed(request):
+                    response = await respond_to_change_feed_async(writer, request)
                 else:
-                    # make sure this is actually a path
-                    if path[0] == "/":
-                        path_tokens = path[1:].split("/")
-                        # print(path_tokens)
-                        if path_tokens[0] == "api":
-                            response = handle_api(database_conn, method, path_tokens[1:], remaining_request, body)
-                            respond_and_close(response, socket_conn, database_conn)
-
-                        # if it's not an api request, open the files
-                        else:
+                    response = await loop.run_in_executor(None, respond_with_database, request)
 
-                            if path == '/':
-                                handle_file(socket_conn, database_conn, method, ['index.html'])
-                            else:
-                                handle_file(socket_conn, database_conn, method, path_tokens)
+                # an event stream was already sent, and it ends with the connection
+                if response is None:
+                    keep_alive = False
 
-                    else:
-                        respond_and_close(bad_request(), socket_conn, database_conn)
+                else:
+                    requests_left = MAX_KEEP_ALIVE_REQUESTS - requests_served
+                    response = add_connection_header(response, keep_alive, requests_left)
+                    started = time.perf_counter()
+                    if not await send_response_async(writer, response):
+                        keep_alive = False
+                    request['stages']['send'] = time.perf_counter() - started
+
+                record_request(request, response)
+
+    # the request was malformed or too big, so we can't tell where the next one starts
+    except httpparser.ParseError as e:
+        record_parse_error(e.status)
+        writer.writelines(response_buffers(add_connection_header(error_response(e.status), False, 0)))
+
+    # the client went quiet or went away. nothing to do but clean up
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+
+    finally:
+        ACTIVE_CONNECTIONS.dec()
+        writer.close()
+
+
+# answer a connection we don't have room for with a 503 and hang up.
+# this runs on the accept loop, so it must never block for long
+def reject_connection(socket_conn):
+    try:
+        socket_conn.setblocking(False)
+        socket_conn.sendmsg(response_buffers(service_unavailable()))
+    except OSError:
+        # the client is getting turned away either way
+        pass
+    socket_conn.close()
 
-        except Exception:
-            respond_and_close(server_error(), socket_conn, database_conn)
 
+# returns the current queue depth and the accepted/rejected connection counts
+def pool_statistics(connection_queue):
+    with pool_stats_lock:
+        stats = dict(pool_stats)
+    stats['queue_depth'] = connection_queue.qsize()
+    return stats
 
-# start listening for connections and then pass them to handle_client which will run in a new thread
-def start():
+
+# hands a keep-alive connection with nothing to read to the idle connection watcher
+# param state: [parser, requests served], so the connection carries on where it left off
+def park_connection(socket_conn, addr, state):
+    arrivals, wakeup = IDLE_CONNECTIONS
+    arrivals.put((socket_conn, addr, state))
+    try:
+        wakeup.send(b'\0')
+    # the watcher already has a wakeup waiting
+    except BlockingIOError:
+        pass
+
+
+# one thread waits on every idle connection at once. a connection goes back on the worker
+# queue as soon as the client sends something, and gets closed if it stays quiet too long
+def watch_idle_connections(connection_queue, arrivals, wakeup):
+    selector = selectors.DefaultSelector()
+    selector.register(wakeup, selectors.EVENT_READ)
+    # socket -> time it gets closed if it's still quiet
+    deadlines = {}
+    next_sweep = time.monotonic() + IDLE_SWEEP_INTERVAL
+
+    while True:
+        for key, _ in selector.select(IDLE_SWEEP_INTERVAL):
+            if key.fileobj is wakeup:
+                try:
+                    while wakeup.recv(RECV_SIZE):
+                        pass
+                except BlockingIOError:
+                    pass
+
+            else:
+                selector.unregister(key.fileobj)
+                del deadlines[key.fileobj]
+                # waits for room when the queue is full. every worker is busy then anyway
+                connection_queue.put((key.fileobj,) + key.data)
+
+        while not arrivals.empty():
+            socket_conn, addr, state = arrivals.get()
+            selector.register(socket_conn, selectors.EVENT_READ, (addr, state))
+            deadlines[socket_conn] = time.monotonic() + KEEP_ALIVE_TIMEOUT
+
+        now = time.monotonic()
+        if now >= next_sweep:
+            next_sweep = now + IDLE_SWEEP_INTERVAL
+            for socket_conn, deadline in list(deadlines.items()):
+                if deadline <= now:
+                    selector.unregister(socket_conn)
+                    del deadlines[socket_conn]
+                    close_client(socket_conn)
+
+
+def start_idle_connection_watcher(connection_queue):
+    global IDLE_CONNECTIONS
+
+    arrivals = queue.SimpleQueue()
+    wakeup, wakeup_sender = socket.socketpair()
+    wakeup.setblocking(False)
+    wakeup_sender.setblocking(False)
+    IDLE_CONNECTIONS = [arrivals, wakeup_sender]
+
+    watcher = threading.Thread(target=watch_idle_connections, args=(connection_queue, arrivals, wakeup),
+                               daemon=True)
+    watcher.start()
+
+
+# worker threads sit here forever pulling connections off the queue
+def pool_worker(connection_queue):
+    while True:
+        socket_conn, addr, state = connection_queue.get()
+        try:
+            handle_client(socket_conn, addr, state, park=True)
+        except Exception as e:
+            serverlog.error('Worker failed to handle the connection.', error=e)
+            close_client(socket_conn)
+        finally:
+            connection_queue.task_done()
+
+
+def start_workers(connection_queue, pool_size):
+    for _ in range(pool_size):
+        worker = threading.Thread(target=pool_worker, args=(connection_queue,), daemon=True)
+        worker.start()
+
+
+def create_server_socket(address):
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind(ADDRESS)
+    if REUSE_PORT:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server.bind(address)
     # server.settimeout(10)  # you have 10 seconds to respond
     server.listen()
-    print(f"[LISTENING] Server is listening on {HOST}")
+    return server
+
+
+# start listening for connections and then pass them to handle_client which will run in a new thread
+def start(address):
+    server = create_server_socket(address)
+    serverlog.info('listening', port=address[1], mode='threads')
     # we'll keep listening forever
     while True:
         try:
             conn, addr = server.accept()  # blocking code
             thread = threading.Thread(target=handle_client, args=(conn, addr))
             thread.start()
-            print(f"[NUMBER OF THREADS] {threading.active_count() - 1}")
+            serverlog.debug('connection thread started', threads=threading.active_count() - 1)
 
         # except socket.timeout:
         #     print("timed out...\n")
 
         except KeyboardInterrupt:
-            print("Bye!")
+            serverlog.info('server is stopping')
             server.close()
             sys.exit(0)
 
         except Exception as e:
-            print("Something bad happened!\n")
-            print(e)
+            serverlog.error('Failed to accept a connection.', error=e)
+
+
+# same as start() except connections are queued up for a fixed set of worker threads.
+# when the queue is full we answer with a 503 right away instead of piling up more threads
+# param change_feed_waiters: workers that can be waiting on the change feed at once
+def start_pool(address, pool_size, backlog, change_feed_waiters):
+    global CONNECTION_QUEUE, CHANGE_FEED_SLOTS
+
+    connection_queue = queue.Queue(maxsize=backlog)
+    CONNECTION_QUEUE = connection_queue
+    CHANGE_FEED_SLOTS = threading.BoundedSemaphore(change_feed_waiters)
+    start_idle_connection_watcher(connection_queue)
+    start_workers(connection_queue, pool_size)
+
+    server = create_server_socket(address)
+    serverlog.info('listening', port=address[1], mode='pool', workers=pool_size)
+    while True:
+        try:
+            conn, addr = server.accept()  # blocking code
+            try:
+                connection_queue.put_nowait((conn, addr, None))
+                with pool_stats_lock:
+                    pool_stats['accepted'] += 1
+
+            # every worker is busy and the backlog is full
+            except queue.Full:
+                reject_connection(conn)
+                with pool_stats_lock:
+                    pool_stats['rejected'] += 1
+
+            if serverlog.LOG_LEVEL <= serverlog.LEVELS['debug']:
+                stats = pool_statistics(connection_queue)
+                serverlog.debug('connection queued', queue_depth=stats['queue_depth'], rejected=stats['rejected'])
+
+        except KeyboardInterrupt:
+            serverlog.info('server is stopping')
+            server.close()
+            sys.exit(0)
+
+        except Exception as e:
+            serverlog.error('Failed to accept a connection.', error=e)
+
+
+async def serve_async(address, executor_threads):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=executor_threads))
+
+    server = await asyncio.start_server(handle_client_async, address[0], address[1], reuse_address=True,
+                                        reuse_port=REUSE_PORT or None, backlog=ACCEPT_BACKLOG)
+    serverlog.info('listening', port=address[1], mode='async', executor_threads=executor_threads)
+    async with server:
+        await server.serve_forever()
+
+
+# one event loop holds every connection. idle and slow clients only cost a socket,
+# and at most executor_threads requests touch the database at once
+def start_async(address, executor_threads):
+    try:
+        asyncio.run(serve_async(address, executor_threads))
+    except KeyboardInterrupt:
+        serverlog.info('server is stopping')
+        sys.exit(0)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Memo system web server')
+    parser.add_argument('--mode', choices=['threads', 'pool', 'async'], default=SERVER_MODE,
+                        help='one thread per connection, a fixed pool of worker threads, or an asyncio event loop')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='worker processes sharing the port, each serving in --mode. 0 serves from this process')
+    parser.add_argument('--port', type=int, default=PORT,
+                        help='port to listen on')
+    parser.add_argument('--database', default=DATABASE,
+                        help='sqlite database file holding the memos and sessions')
+    parser.add_argument('--document-root', default=DOCUMENT_ROOT,
+                        help='directory the static files are served from')
+    parser.add_argument('--static-refresh', type=float, default=STATIC_REFRESH_INTERVAL,
+                        help='seconds between checks for new or changed static files, 0 to never check')
+    parser.add_argument('--file-cache-size', type=int, default=FILE_CACHE_BYTES,
+                        help='bytes of small static files kept in memory, 0 to always read from disk')
+    parser.add_argument('--gzip-level', type=int, default=GZIP_LEVEL, choices=range(10),
+                        help='gzip level for compressed responses, 0 to never compress')
+    parser.add_argument('--gzip-min-size', type=int, default=GZIP_MIN_SIZE,
+                        help='smallest body in bytes worth compressing')
+    parser.add_argument('--db-pool-size', type=int, default=DATABASE_POOL_SIZE,
+                        help='database connections shared by all requests')
+    parser.add_argument('--group-commit-size', type=int, default=memodb.GROUP_COMMIT_SIZE,
+                        help='most writes committed together by the writer thread, 0 to commit each on its own')
+    parser.add_argument('--group-commit-delay', type=float, default=memodb.GROUP_COMMIT_DELAY * 1000,
+                        help='milliseconds the writer waits for more writes to join a commit')
+    parser.add_argument('--pool-size', type=int, default=POOL_SIZE,
+                        help='number of worker threads in pool mode')
+    parser.add_argument('--backlog', type=int, default=ACCEPT_BACKLOG,
+                        help='connections that can wait for a worker before we answer 503')
+    parser.add_argument('--change-feed-waiters', type=int,
+                        help='long-polls and event streams that can wait at once in pool mode, '
+                             'half of --pool-size by default. more get a 503')
+    parser.add_argument('--executor-threads', type=int, default=EXECUTOR_THREADS,
+                        help='threads doing database and file work in async mode')
+    parser.add_argument('--session-lifetime', type=float, default=memodb.SESSION_LIFETIME / 86400,
+                        help='days a session is accepted for after it was last seen, or a signed session cookie '
+                             'after it was issued. expired sessions that own no memos are deleted')
+    parser.add_argument('--session-prune-interval', type=float, default=memodb.SESSION_PRUNE_INTERVAL,
+                        help='seconds between sweeps for expired sessions, 0 to never delete them')
+    parser.add_argument('--session-keys',
+                        help='file of keys, one "<key id> <secret>" per line, to sign session cookies with. '
+                             'the first signs, the rest are still accepted')
+    parser.add_argument('--session-cache-size', type=int, default=SESSION_CACHE_SIZE,
+                        help='session ids remembered in memory')
+    parser.add_argument('--session-cache-ttl', type=float, default=SESSION_CACHE_TTL,
+                        help='seconds a remembered session id is trusted before checking the database again')
+    parser.add_argument('--compact-json', action='store_true',
+                        help='send the memo list without indentation')
+    parser.add_argument('--max-header-size', type=int, default=MAX_HEADER_SIZE,
+                        help='largest request line plus headers in bytes, bigger gets a 431')
+    parser.add_argument('--max-body-size', type=int, default=MAX_BODY_SIZE,
+                        help='largest request body in bytes, bigger gets a 413')
+    parser.add_argument('--log-level', choices=list(serverlog.LEVELS), default='info',
+                        help='least important messages written to the log, warning or error turns off the access log')
+    parser.add_argument('--log-file', default='-',
+                        help='file the JSON lines log is appended to, - for standard output')
+    parser.add_argument('--access-log-sample', type=float, default=serverlog.ACCESS_SAMPLE_RATE,
+                        help='share of successful requests logged, from 0 to 1. failed requests are always logged')
+    return parser.parse_args()
+
+
+# opens the connection pool and makes sure the tables exist. this happens once at
+# startup so requests never pay for opening the file or running the DDL.
+# then the group commit writer takes over all the writes.
+# param create_tables: False for workers, whose supervisor already made the tables
+def setup_database(database, pool_size, group_commit_size, group_commit_delay, create_tables=True):
+    pool = memodb.create_connection_pool(database, pool_size)
+
+    if pool is not None:
+        if create_tables:
+            database_conn = memodb.get_pooled_connection(pool)
+            initialize_db(database_conn)
+            memodb.return_pooled_connection(pool, database_conn)
+
+        if not memodb.start_group_commit(database, group_commit_size, group_commit_delay):
+            memodb.close_connection_pool(pool)
+            pool = None
+
+    return pool
+
+
+# opens the database and the static files, then serves connections in the chosen mode until we're stopped.
+# param prune_sessions: False for all but one of the workers, so only one of them sweeps the sessions table
+def serve(arguments, address, create_tables=True, prune_sessions=True):
+    global DATABASE_POOL
+
+    DATABASE_POOL = setup_database(DATABASE, arguments.db_pool_size, arguments.group_commit_size,
+                                   arguments.group_commit_delay / 1000, create_tables)
+    if DATABASE_POOL is None:
+        serverlog.error('Could not create the database connection.', database=DATABASE)
+        sys.exit(1)
+
+    if prune_sessions and arguments.session_prune_interval > 0:
+        if not memodb.start_session_pruner(DATABASE, arguments.session_lifetime * 86400,
+                                           arguments.session_prune_interval):
+            serverlog.error('Could not create the database connection.', database=DATABASE)
+            sys.exit(1)
+
+    file_count = staticfiles.start_file_index(arguments.document_root, arguments.static_refresh)
+    serverlog.info('static files indexed', files=file_count, document_root=arguments.document_root)
+
+    if arguments.mode == 'pool':
+        change_feed_waiters = arguments.change_feed_waiters
+        if change_feed_waiters is None:
+            change_feed_waiters = max(1, arguments.pool_size // 2)
+        start_pool(address, arguments.pool_size, arguments.backlog, change_feed_waiters)
+    elif arguments.mode == 'async':
+        start_async(address, arguments.executor_threads)
+    else:
+        start(address)
+
+
+# lets SIGTERM stop a process the same way Ctrl-C does
+def stop_on_signal(signum, frame):
+    raise KeyboardInterrupt
+
+
+# runs in the forked child. nothing from the supervisor is running here yet, so this
+# sets up the logging thread, the database and the listening socket of its own
+# param slot: which worker this is, from 0 up to the number of workers - 1
+def run_worker(arguments, address, slot):
+    global REUSE_PORT
+
+    REUSE_PORT = True
+    serverlog.start_writer()
+    serverlog.info('worker started', worker=slot, pid=os.getpid())
+
+    # other workers write to the same database, and the change log and memo list cache
+    # have to hear about it too. versions become the database's revisions, so the memo list
+    # ETag and change feed versions from one worker are good with every other
+    if not memodb.start_revision_watch(DATABASE):
+        serverlog.error('Could not create the database connection.', database=DATABASE)
+        sys.exit(1)
+
+    serve(arguments, address, create_tables=False, prune_sessions=slot == 0)
+
+
+# return: the new worker's process id. the child never returns from here
+def start_worker_process(arguments, address, slot):
+    sys.stdout.flush()
+    pid = os.fork()
+
+    if pid == 0:
+        # a worker stopped before it got as far as serving must not run the supervisor's cleanup
+        try:
+            run_worker(arguments, address, slot)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    return pid
+
+
+# tells every worker to stop, waits for them to finish up, and kills any that take too long
+# param workers: {process id: [slot, time it started]}
+def stop_worker_processes(workers):
+    # we're already stopping, so another Ctrl+C or SIGTERM mustn't interrupt the cleanup
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+    while workers and time.monotonic() < deadline:
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            time.sleep(0.1)
+        else:
+            workers.pop(pid, None)
+
+    for pid in workers:
+        serverlog.warning('worker did not stop in time, killing it', pid=pid)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+
+# makes the tables once, then forks the workers and starts a new one whenever one dies.
+# the supervisor itself never touches a socket or a pooled connection, so its children start clean
+def supervise_workers(arguments, address):
+    database_conn = memodb.create_pooled_connection(DATABASE)
+    if database_conn is None:
+        serverlog.error('Could not create the database connection.', database=DATABASE)
+        sys.exit(1)
+    initialize_db(database_conn)
+    database_conn.close()
+
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    workers = {}
+
+    try:
+        for slot in range(arguments.workers):
+            workers[start_worker_process(arguments, address, slot)] = [slot, time.monotonic()]
+        serverlog.info('listening', port=address[1], mode=arguments.mode, workers=arguments.workers)
+
+        while True:
+            pid, status = os.wait()
+            slot, started = workers.pop(pid)
+            serverlog.warning('worker stopped, starting another', worker=slot, pid=pid,
+                              exit_status=os.waitstatus_to_exitcode(status))
+            if time.monotonic() - started < WORKER_RESTART_DELAY:
+                time.sleep(WORKER_RESTART_DELAY)
+            workers[start_worker_process(arguments, address, slot)] = [slot, time.monotonic()]
+
+    except KeyboardInterrupt:
+        stop_worker_processes(workers)
+        serverlog.info('server is stopping')
+        sys.exit(0)
 
 
 def main():
-    print("[STARTING] server is starting...")
-    start()
+    global DATABASE, MAX_HEADER_SIZE, MAX_BODY_SIZE, MEMO_JSON_INDENT, FILE_CACHE
+    global GZIP_LEVEL, GZIP_MIN_SIZE, SESSION_CACHE, SESSION_LIFETIME
+
+    arguments = parse_arguments()
+    DATABASE = arguments.database
+    MAX_HEADER_SIZE = arguments.max_header_size
+    MAX_BODY_SIZE = arguments.max_body_size
+    SESSION_CACHE = cache.LRUCache(arguments.session_cache_size, arguments.session_cache_ttl)
+    SESSION_LIFETIME = arguments.session_lifetime * 86400
+    if arguments.compact_json:
+        MEMO_JSON_INDENT = None
+    GZIP_LEVEL = arguments.gzip_level
+    GZIP_MIN_SIZE = arguments.gzip_min_size
+    FILE_CACHE = None
+    if arguments.file_cache_size > 0:
+        FILE_CACHE = cache.LRUCache(max_bytes=arguments.file_cache_size)
+    address = (HOST, arguments.port)
+
+    log_stream = sys.stdout
+    if arguments.log_file != '-':
+        log_stream = open(arguments.log_file, 'a', encoding=FORMAT)
+    serverlog.configure(log_stream, arguments.log_level, arguments.access_log_sample)
+
+    # workers are forked after this, so they all sign and check with the same keys
+    if arguments.session_keys is not None:
+        try:
+            session_keys = sessiontokens.load_keys(arguments.session_keys)
+        except (OSError, ValueError) as e:
+            serverlog.error('Could not load the session keys.', path=arguments.session_keys, error=e)
+            sys.exit(1)
+        sessiontokens.configure(session_keys, arguments.session_lifetime * 86400)
+
+    serverlog.info('server is starting')
+    if arguments.workers > 0:
+        supervise_workers(arguments, address)
+    else:
+        serverlog.start_writer()
+        serve(arguments, address)
 
 
 main()
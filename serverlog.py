@@ -0,0 +1,153 @@
+import json
+import queue
+import random
+import sys
+import threading
+import time
+import atexit
+import metrics
+
+# messages below the chosen level are thrown away before they're even queued
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+LOG_LEVEL = LEVELS['info']
+
+# share of successful requests that get an access record. requests that failed are always logged
+ACCESS_SAMPLE_RATE = 1.0
+
+# records waiting for the writer thread. if it falls this far behind, new records are dropped
+# (and counted) rather than letting the request threads wait on the output
+MAX_QUEUE_SIZE = 10000
+
+# most records written with one write() and flush()
+MAX_BATCH_SIZE = 256
+
+DROPPED_RECORDS = metrics.Counter('memo_log_records_dropped_total',
+                                  'Log records thrown away because the log writer fell behind.')
+
+log_stream = sys.stdout
+# None until start_writer() is called. until then records are written straight away by whoever made them
+log_queue = None
+log_writer = None
+# tells the writer thread to write what's left and stop
+STOP = object()
+
+
+# records are one JSON object per line. anything json doesn't know (like an exception) is written as its str()
+def encode_record(record):
+    return json.dumps(record, default=str)
+
+
+def write_records(records):
+    try:
+        log_stream.write(''.join(encode_record(record) + '\n' for record in records))
+        log_stream.flush()
+    except (OSError, ValueError):
+        # nowhere left to log to. the server carries on without it
+        pass
+
+
+# the writer thread waits for a record, then takes whatever else has piled up behind it
+# so a busy server pays for one write and flush per batch instead of per line
+def write_log_queue(records_queue):
+    running = True
+
+    while running:
+        batch = [records_queue.get()]
+        while len(batch) < MAX_BATCH_SIZE:
+            try:
+                batch.append(records_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        if STOP in batch:
+            running = False
+            batch = [record for record in batch if record is not STOP]
+        write_records(batch)
+
+
+# param stream: a file-like object to write the JSON lines to
+# param level: name of the lowest level written, one of LEVELS
+# param sample_rate: 0 to 1, the share of successful requests that get an access record
+def configure(stream, level='info', sample_rate=ACCESS_SAMPLE_RATE):
+    global log_stream, LOG_LEVEL, ACCESS_SAMPLE_RATE
+
+    log_stream = stream
+    LOG_LEVEL = LEVELS[level]
+    ACCESS_SAMPLE_RATE = sample_rate
+
+
+# hands writing over to a background thread. a process that's going to fork
+# leaves this to its children, since the thread wouldn't come along
+def start_writer():
+    global log_queue, log_writer
+
+    records_queue = queue.Queue(maxsize=MAX_QUEUE_SIZE)
+    log_writer = threading.Thread(target=write_log_queue, args=(records_queue,), daemon=True)
+    log_writer.start()
+    log_queue = records_queue
+    atexit.register(stop)
+
+
+# writes whatever is still queued. called on the way out so the last records aren't lost
+def stop(timeout=2):
+    global log_queue
+
+    records_queue = log_queue
+    if records_queue is not None:
+        log_queue = None
+        # a full queue still has room for this once the writer takes its next batch
+        try:
+            records_queue.put(STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        log_writer.join(timeout)
+
+
+def emit(record):
+    records_queue = log_queue
+    if records_queue is None:
+        write_records([record])
+    else:
+        try:
+            records_queue.put_nowait(record)
+        except queue.Full:
+            DROPPED_RECORDS.inc()
+
+
+# param fields: anything else worth keeping with the message, like error=e
+def log(level, message, **fields):
+    if LEVELS[level] >= LOG_LEVEL:
+        record = {'time': round(time.time(), 3), 'level': level, 'message': message}
+        record.update(fields)
+        emit(record)
+
+
+def debug(message, **fields):
+    log('debug', message, **fields)
+
+
+def info(message, **fields):
+    log('info', message, **fields)
+
+
+def warning(message, **fields):
+    log('warning', message, **fields)
+
+
+def error(message, **fields):
+    log('error', message, **fields)
+
+
+# access records are logged at info. callers check this first so a request that isn't
+# sampled doesn't pay for building its record
+def wants_access_record(status):
+    if LOG_LEVEL > LEVELS['info']:
+        return False
+    return status[0] in '45' or ACCESS_SAMPLE_RATE >= 1 or random.random() < ACCESS_SAMPLE_RATE
+
+
+# param duration: seconds the request took, or None if it has no end worth timing
+def access(method, path, status, size, duration, session):
+    emit({'time': round(time.time(), 3), 'level': 'info', 'message': 'access', 'method': method, 'path': path,
+          'status': int(status), 'bytes': size,
+          'duration_ms': None if duration is None else round(duration * 1000, 3), 'session': session})
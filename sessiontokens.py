@@ -0,0 +1,99 @@
+import base64
+import hashlib
+import hmac
+import time
+
+# key id -> secret. the first key signs every new token. the others are only checked,
+# so tokens signed before a key was rotated out keep working until they're refreshed
+SIGNING_KEYS = {}
+SIGNING_KEY_ID = None
+# secrets shorter than this are refused, since anyone who guesses one can sign any session
+MIN_SECRET_LENGTH = 16
+# seconds a token is accepted for after it was issued
+MAX_TOKEN_AGE = 30 * 24 * 60 * 60
+# a token older than this, or signed with a key that's been rotated out, is swapped for a
+# new one for the same session the next time the client reads the memo list
+REFRESH_AGE = 24 * 60 * 60
+# seconds a token's issued-at can be ahead of our clock, for servers whose clocks disagree a little
+CLOCK_SKEW = 60
+
+# tokens are "<session id>.<issued at>.<key id>.<signature>". cookie values
+# can't hold "=", so the signature is base64 without its padding
+SEPARATOR = '.'
+
+
+# the key file has one key per line: its id and then its secret, separated by a space.
+# blank lines and lines starting with # are skipped
+# return: [[key id, secret], ...] in the order they're in the file
+def load_keys(path):
+    keys = []
+    with open(path, encoding='utf-8') as key_file:
+        for line in key_file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            key_id, _, secret = line.partition(' ')
+            secret = secret.strip()
+            if not key_id or SEPARATOR in key_id or not secret:
+                raise ValueError('expected a key id without a "." and a secret: {}'.format(key_id))
+            if len(secret) < MIN_SECRET_LENGTH:
+                raise ValueError('secret for key {} is shorter than {} characters'.format(key_id, MIN_SECRET_LENGTH))
+            keys.append([key_id, secret])
+
+    if not keys:
+        raise ValueError('no keys in {}'.format(path))
+    return keys
+
+
+# param keys: [[key id, secret], ...]. the first one signs. none at all turns signing off
+# param max_age: seconds a token is accepted for
+def configure(keys, max_age=MAX_TOKEN_AGE):
+    global SIGNING_KEYS, SIGNING_KEY_ID, MAX_TOKEN_AGE
+
+    SIGNING_KEYS = {key_id: secret.encode('utf-8') for key_id, secret in keys}
+    SIGNING_KEY_ID = keys[0][0] if keys else None
+    MAX_TOKEN_AGE = max_age
+
+
+def enabled():
+    return SIGNING_KEY_ID is not None
+
+
+def signature(secret, message):
+    digest = hmac.new(secret, message.encode('utf-8'), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+
+# return: a token for the session, signed with the current key
+def sign(session_id, issued=None):
+    if issued is None:
+        issued = int(time.time())
+    message = SEPARATOR.join([session_id, str(issued), SIGNING_KEY_ID])
+    return message + SEPARATOR + signature(SIGNING_KEYS[SIGNING_KEY_ID], message)
+
+
+# checks the signature and age of a token without looking anything up
+# return: [session id, True if it's due to be refreshed], or None if the token isn't one of ours
+def verify(token):
+    parts = token.split(SEPARATOR)
+    if len(parts) != 4:
+        return None
+
+    session_id, issued, key_id, token_signature = parts
+    secret = SIGNING_KEYS.get(key_id)
+    if secret is None:
+        return None
+
+    message = token[:-len(token_signature) - 1]
+    if not hmac.compare_digest(signature(secret, message).encode('ascii'), token_signature.encode('utf-8')):
+        return None
+
+    try:
+        age = time.time() - int(issued)
+    except ValueError:
+        return None
+    if age > MAX_TOKEN_AGE or age < -CLOCK_SKEW:
+        return None
+
+    return [session_id, age > REFRESH_AGE or key_id != SIGNING_KEY_ID]
@@ -0,0 +1,101 @@
+import os
+import time
+import threading
+import posixpath
+import serverlog
+from urllib.parse import unquote
+
+# default type is
+DEFAULT_CONTENT_TYPE = 'text/plain; charset=us-ascii'
+CONTENT_TYPES = {
+    '.jpeg': 'image/jpeg',
+    '.jpg': 'image/jpeg',
+    '.png': 'image/png',
+    '.ico': 'image/vnd.microsoft.icon',
+    '.html': 'text/html',
+}
+# what a request for a directory gets
+DIRECTORY_INDEX = 'index.html'
+
+# request path relative to the document root ('images/f.jpeg') ->
+# [path on disk, content type, size in bytes, modification time]
+# the whole dict gets swapped out on a refresh, so readers never need a lock
+file_index = {}
+
+
+def content_type_for(file_name):
+    extension = os.path.splitext(file_name)[1].lower()
+    return CONTENT_TYPES.get(extension, DEFAULT_CONTENT_TYPE)
+
+
+# walks the document root once and records every file we can serve.
+# hidden files and directories (.git and friends) are left out
+def build_file_index(document_root):
+    index = {}
+
+    for root, directories, files in os.walk(document_root):
+        directories[:] = [name for name in directories if not name.startswith('.')]
+
+        for name in files:
+            if name.startswith('.'):
+                continue
+
+            path_name = os.path.join(root, name)
+            try:
+                file_stat = os.stat(path_name)
+            except OSError:
+                # it went away while we were looking
+                continue
+
+            request_path = os.path.relpath(path_name, document_root).replace(os.sep, '/')
+            index[request_path] = [path_name, content_type_for(name), file_stat.st_size, file_stat.st_mtime]
+
+    return index
+
+
+def refresh_file_index(document_root):
+    global file_index
+
+    file_index = build_file_index(document_root)
+
+
+# re-walks the document root every interval seconds so new, changed and deleted files get noticed
+def poll_file_index(document_root, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            refresh_file_index(document_root)
+        except OSError as e:
+            serverlog.error('Failed to refresh the static file index.', error=e)
+
+
+# param refresh_interval: seconds between re-walks of the document root, 0 to never refresh
+def start_file_index(document_root, refresh_interval):
+    refresh_file_index(document_root)
+
+    if refresh_interval > 0:
+        poller = threading.Thread(target=poll_file_index, args=(document_root, refresh_interval), daemon=True)
+        poller.start()
+
+    return len(file_index)
+
+
+# turns the path from the request line into a key for the index.
+# "/images/../images/./f.jpeg" and "/images/f%2Ejpeg" both become "images/f.jpeg"
+def request_path_key(path):
+    path = unquote(path)
+    wants_directory = path.endswith('/')
+
+    # normalizing from "/" means ".." can never climb out of the document root
+    key = posixpath.normpath('/' + path).lstrip('/')
+    if not key:
+        key = DIRECTORY_INDEX
+    elif wants_directory:
+        key = '{}/{}'.format(key, DIRECTORY_INDEX)
+
+    return key
+
+
+# return: [path on disk, content type, size, modification time], or None if we don't have the file
+def lookup_file(path):
+    return file_index.get(request_path_key(path))